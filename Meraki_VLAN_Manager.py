@@ -1,27 +1,82 @@
-import importlib.metadata
+import argparse
+import asyncio
 import os
-import logging
 import csv
+import difflib
+import itertools
+import json
+import sqlite3
+import queue
+import atexit
+import concurrent.futures
+from datetime import datetime
 import threading
-import subprocess
 import sys
 import re
 import time
 import webbrowser
+import merakiCommon
+from merakiCommon import (callMetrics, traced, runAsync, runJobQueue, reportJobs,
+                          activeClient, currentClient, useClient, selectOrganizations, getSwitches)
 
 #global thread lock used to prevent race condition when writing rollback data
 lock = threading.Lock()
-# make sure that meraki is installed by first declaring a list of external libraries required
-required = {'meraki'}
-# then get a list of installed packages
-installed = {pkg.metadata['Name'] for pkg in importlib.metadata.distributions()}
-# find what's missing by subtracting what's installed from what's required
-missing = required - installed
-# if anything is missing install it via pip
-if missing:
-    subprocess.check_call([sys.executable, '-m', 'pip', 'install', *missing])
-# now that we can sure sure meraki is installed import the library
-import meraki # type: ignore
+#-------------------------------------------------------------------------------------
+# CLIENT CONTEXT
+MAX_PARALLEL_ORGS = 8           # organizations worked on at once, each has its own rate limit so they don't slow each other down
+stopRequested = threading.Event()   # set by Ctrl-C while several orgs run in parallel, runs stop between windows
+
+class RunStopped(Exception):
+    """a run that was stopped between windows, it can be finished with --resume"""
+
+class MerakiClient(merakiCommon.MerakiClient):
+    """The shared per-org client plus the org's port cache, the org's switches are kept as a SwitchIndex"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.portInventory = PortInventory()
+
+def runAcrossOrgs(clients, operation):
+    """calls operation() once for every client with its client current, a single org on the calling thread and several
+    up to MAX_PARALLEL_ORGS at a time each in its own thread. Ctrl-C sets stopRequested and waits for every org to stop
+    at the end of its current window before being raised again.
+    returns a dict of client to what operation returned, or to the exception it raised so one org failing doesn't stop the rest"""
+    def runOrg(client):
+        with useClient(client):
+            return operation()
+    if len(clients) == 1:
+        # Ctrl-C only reaches the main thread so one org runs here where it can be interrupted straight away
+        try:
+            return {clients[0]: runOrg(clients[0])}
+        except Exception as e:
+            return {clients[0]: e}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_ORGS, len(clients)))
+    futures = {client: executor.submit(runOrg, client) for client in clients}
+    try:
+        # waiting with a timeout keeps the main thread able to take a KeyboardInterrupt
+        while concurrent.futures.wait(futures.values(), timeout=0.5).not_done:
+            pass
+    except KeyboardInterrupt:
+        print("\nStopping, every organization finishes the window it's working on first")
+        stopRequested.set()
+        concurrent.futures.wait(futures.values())
+        stopRequested.clear()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+    results = {}
+    for client, future in futures.items():
+        try:
+            results[client] = future.result()
+        except Exception as e:
+            results[client] = e
+    return results
+
+def clientForOrg(orgID):
+    """the current client if it works on orgID, otherwise a client for orgID with the same key"""
+    client = currentClient()
+    if orgID is None or str(orgID) == str(client.orgID):
+        return client
+    return client.forOrganization({'id': orgID})
 
 #-------------------------------------------------------------------------------------
 #USER INPUT FUNCTIONS
@@ -127,6 +182,8 @@ def getSerialFromUser(switches):
             # now that we have confirmed the switch's name is in the correct format we can grab the serial number using the name
             switchName = serialNum
             serialNum = getSerialByName(switches, serialNum)
+            if not serialNum:
+                suggestSwitchNames(switches, switchName)
         # else if we know they entered a serial number we can convert it to uppercase and grab the switch's name
         else:
             serialNum = serialNum.upper()
@@ -164,6 +221,8 @@ def getListOfSerialsFromUser(switches):
                             entry = entry.upper()
                         switchName = entry
                         entry = getSerialByName(switches, entry)
+                        if not entry:
+                            suggestSwitchNames(switches, switchName)
                         
                     else:
                         entry = entry.upper()
@@ -198,32 +257,101 @@ def dispOptions(*args):
     makeMenu(*args)
     input("Press enter to continue")
 
+class SwitchIndex(list):
+    """The list of switches from getSwitches with lookups built once so finding a switch doesn't walk the list.
+    serials and names are hash maps, name prefixes are a trie whose nodes remember the first switch in list
+    order under them so a prefix lookup returns the same switch the old startswith scan did"""
+    def __init__(self, switches = ()):
+        super().__init__(switches)
+        self.bySerial = {}      # serial -> switch
+        self.byName = {}        # exact name -> switch
+        self.prefixes = {}      # trie of names, each node's "" key holds the first switch below it
+        self.lowerPrefixes = {} # the same trie with the names in lower case
+        self.lowerNames = {}    # lower case name -> name, used for fuzzy matching
+        for switch in self:
+            self.bySerial.setdefault(switch['serial'].upper(), switch)
+            self.byName.setdefault(switch['name'], switch)
+            self.lowerNames.setdefault(switch['name'].lower(), switch['name'])
+            self._addPrefixes(self.prefixes, switch['name'], switch)
+            self._addPrefixes(self.lowerPrefixes, switch['name'].lower(), switch)
+
+    def _addPrefixes(self, trie, name, switch):
+        node = trie
+        node.setdefault("", switch)
+        for char in name:
+            node = node.setdefault(char, {})
+            node.setdefault("", switch)     # setdefault keeps the first switch in list order
+
+    def _findPrefix(self, trie, prefix):
+        node = trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node.get("")
+
+    def bySerialNumber(self, serial):
+        """the switch with this serial, serials aren't case sensitive"""
+        return self.bySerial.get(serial.upper())
+
+    def byNamePrefix(self, name, ignoreCase = False):
+        """the first switch whose name is or starts with name"""
+        switch = self.byName.get(name)
+        if switch is None:
+            switch = self._findPrefix(self.lowerPrefixes, name.lower()) if ignoreCase else self._findPrefix(self.prefixes, name)
+        return switch
+
+    def byExactName(self, name):
+        """the switch called name, ignoring case but never matching part of a name"""
+        switch = self.byName.get(name)
+        if switch is None and name.lower() in self.lowerNames:
+            switch = self.byName[self.lowerNames[name.lower()]]
+        return switch
+
+    def closestNames(self, name, count = 3):
+        """names of the switches that look most like name, for suggesting what the user meant"""
+        matches = difflib.get_close_matches(name.lower(), self.lowerNames, n=count, cutoff=0.6)
+        return [self.lowerNames[match] for match in matches]
+
+def indexSwitches(switches):
+    """returns switches as a SwitchIndex, only building one if it isn't already"""
+    return switches if isinstance(switches, SwitchIndex) else SwitchIndex(switches)
+
 def getSerialByName(switches, switchName):
-        """ given a switch's name this function retunrs the switch's serial number"""
-        return next((switch['serial'] for switch in switches if switch['name'].startswith(switchName)), None)
+        """ given a switch's name this function retunrs the switch's serial number
+        an exact or prefix match wins, otherwise the name is matched ignoring case"""
+        switches = indexSwitches(switches)
+        switch = switches.byNamePrefix(switchName) or switches.byNamePrefix(switchName, ignoreCase=True)
+        return switch['serial'] if switch else None
         # return serial number as string
 
 def getNameBySerial(switches, switchSerial):
     """Get a switch's name given its serial number."""
-    return next((switch['name'] for switch in switches if switch['serial'] == switchSerial), None)
+    switch = indexSwitches(switches).bySerialNumber(switchSerial)
+    return switch['name'] if switch else None
+
+def suggestSwitchNames(switches, switchName):
+    """tell the user which switches they might have meant when a name didn't match anything"""
+    suggestions = indexSwitches(switches).closestNames(switchName)
+    if suggestions:
+        print(f"No switch named {switchName} was found, did you mean: {', '.join(suggestions)}")
+    else:
+        print(f"No switch named {switchName} was found")
+
+# compiled once instead of every time a name or serial is checked
+SERIAL_PATTERN = re.compile(r"^[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}$")
+SWITCH_NAME_PATTERN = re.compile(r"^[A-Z][a-z]*\s[A-Z][a-z]*\s\d+$")
 
 # checks if the user entered a serial number or not
 def is_serial_number(entry):
     """Check if what was entered by the user is name or a serial number using a regex"""
-    serial_pattern = r"^[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}$"
-    return bool(re.fullmatch(serial_pattern, entry))
+    return bool(SERIAL_PATTERN.fullmatch(entry))
 
 # this should match switch names like Core Switch or Access Switch while not matching names like TR1450-12XX
 def switchNameCase(name):
     """determine whether a switch's name can be converted into uppercase
     for example a switch named TR1450 can be while a switch called Access Switch 1 can't"""
-    namePattern = r"^[A-Z][a-z]*\s[A-Z][a-z]*\s\d+$"                                                
-    return bool(re.fullmatch(namePattern, name))
-
-def getOrgID():
-    """# Get the orgID from meraki dashboard"""
-    orgs = dashboard.organizations.getOrganizations()  # get organizations list
-    return orgs[0]['id'] if orgs else None  # return the ID from that list
+    return bool(SWITCH_NAME_PATTERN.fullmatch(name))
 
 def makeMenu(menuTitle, *args):
     """takes a variadic amount of string arguments and a title to display a menu"""
@@ -235,12 +363,12 @@ def makeMenu(menuTitle, *args):
 
 #---------------------------------------------------------------------------------------
 # LOGGING FUNCTIONS
-""" Configure logging"""
-logging.basicConfig(filename="vlanChanges.log", level=logging.INFO, format='%(asctime)s - %(message)s')
+LOG_FILE = "vlanChanges.log"   # audit lines are written here in groups by the journal writer
 
 def clearVlanLog():
-    """Clear the contents of the VLAN changes log file using logging library."""
-    with open("vlanChanges.log", 'w') as logFile:
+    """Clear the contents of the VLAN changes log file."""
+    journalWriter.flush()   # make sure queued lines don't land in the file after it's cleared
+    with open(LOG_FILE, 'w') as logFile:
         logFile.truncate()
    
     print("VLAN changes log cleared.")
@@ -249,42 +377,49 @@ def logAction(action = "", switchSerial=0, portId=0, vlan=0, voiceVlan=0):
     """Log VLAN changes to a file.
     change log message to be more reusable"""
     log_message = f"{action} - Switch: {switchSerial}, Port: {portId}, VLAN: {vlan}, Voice VLAN: {voiceVlan}"
-    logging.info(log_message)
+    journalWriter.audit(log_message)
 #----------------------------------------------------------------------------------------
 
 #---------------------------------------------------------------------------------------
 # BULK SWITCH VLAN CHANGE OPERATIONS
 
+@traced
 def bulkChangePortVlan(switchSerial, switchName, portList, vlanId, voiceVlanId):
-    """ Divide the portList into equal parts for each thread"""
-    # worker function to be called by each thread that performs the changeVlan operations
-    def worker(portSubList, failedPorts):
-        for portNumber in portSubList:
-            if not changeVlan( portNumber, vlanId, voiceVlanId, "bulk",False, switchSerial,switchName):
-                print("Failed operation on port ", portNumber)
-                failedPorts.append(portNumber) # if any ports fail append them to a list so we can only display successful ones later
-            print(".", end="")
+    """Change a list of ports on one switch by grouping them into action batches, the ports share one change set"""
+    updates = [(switchSerial, port, vlanId, voiceVlanId) for port in portList]
+    failed = applyPortUpdates(updates, "bulk", {switchSerial: switchName})
+    failedPorts = [port for serial, port in failed]
+    print(f"\nSuccessfully updated VLAN settings for ports {[port for port in portList if str(port) not in failedPorts]} on switch {switchName}.")
 
-    num_threads = 4  # max num of threads is 4 to avoid exceeding rate limit
-    portList_chunks = [portList[i::num_threads] for i in range(num_threads)]
-    threads = []
+@traced
+def perPortChangePortVlan(switchSerial, switchName, portList, vlanId, voiceVlanId, changeSet = None, rollback = False):
+    """ Change each port with its own update call through the job queue, fallback path used when action batches can't be used
+    rollback data is saved under changeSet unless this is itself a rollback. returns the ports that failed"""
     failedPorts = []
-    # for each chunk (should be 4) create a thread that will change the vlans on ports in that chunk
-    for chunk in portList_chunks:
-        thread = threading.Thread(target=worker, args=(chunk, failedPorts))
-        threads.append(thread)
-        thread.start()
-    for thread in threads:
-        thread.join()
-    
-    print(f"\nSuccessfully updated VLAN settings for ports {list(set(portList) - set(failedPorts))} on switch {switchName}.")
-    # Subtract list of failed port operations from the whole list to display which ports were successful
+    changes = {}
+    # fill the port cache first so every port's rollback data is read and saved locally before any updates go out
+    currentClient().portInventory.loadStale([switchSerial])
+    for portNumber in portList:
+        change = preparePortChange(portNumber, vlanId, voiceVlanId, "bulk", rollback, switchSerial, switchName, changeSet)
+        if change:
+            changes[portNumber] = change
+        else:
+            failedPorts.append(portNumber)
+    # every port's rollback record is committed in one group before any port is touched
+    concurrent.futures.wait([change[3] for change in changes.values() if change[3]])
+
+    async def changePort(aioDashboard, portNumber):
+        result = await applyPortChangeAsync(aioDashboard, changes[portNumber], portNumber, "bulk", rollback, switchSerial, switchName)
+        print(".", end="")
+        return result
+
+    results = runAsync(lambda aioDashboard: runJobQueue(list(changes), lambda port: changePort(aioDashboard, port)))
+    # collect the failed ports so we can only display successful ones later
+    failedPorts += [result.item for result in reportJobs(results, f"Port updates on switch {switchName or switchSerial}")]
+    return failedPorts
 
 def changeOnePortMultSwitches(switches, serialsList = [], namesList =[]):
             """Changes a single port across multiple switches in defined by the user"""
-            threads = []
-            max_threads = 4
-            # only allow 4 threads to avoid hitting rate limit
             if not serialsList:
                 serialsList, namesList = getListOfSerialsFromUser(switches)
             enteredPort = getSinglePortFromUser()
@@ -308,22 +443,9 @@ def changeOnePortMultSwitches(switches, serialsList = [], namesList =[]):
                     return serialsList, namesList
                 break
             try:
-                # define a worker function that will be called by each thread to change the vlans on the ports
-                def worker(switch_chunk):
-                    for serial in switch_chunk:
-                        changeVlan(enteredPort, enteredVlan, enteredVoiceVlan,"bulk", False, serial)
-                        print(".", end="")
-                        time.sleep(0.1)  # Add delay to prevent rate limiting
-                
-                switch_chunks = [serialsList[i::max_threads] for i in range(max_threads)]
-            # create a thread to operate on each chunk
-                for chunk in switch_chunks:
-                    thread = threading.Thread(target=worker, args=(chunk,))
-                    threads.append(thread)
-                    thread.start()
-                for thread in threads:
-                    thread.join()
-                
+                # queue the same port on every switch then push them all through the action batch engine
+                updates = [(serial, enteredPort, enteredVlan, enteredVoiceVlan) for serial in serialsList]
+                applyPortUpdates(updates, "bulk", dict(zip(serialsList, namesList)))
             except Exception as e:
                     print("Invalid entries")
                     return
@@ -404,8 +526,12 @@ def changeMultPortsMultSwitches(switches, serialsList = [], namesList =[]):
                         break
                     
                   
-                    for serial, switchName in zip(serialsList, namesList):
-                        bulkChangePortVlan(serial,switchName, portList, enteredVlan, enteredVoiceVlan)
+                    # queue every port on every switch so they can share action batches, only ports that differ are written
+                    updates = [(serial, port, enteredVlan, enteredVoiceVlan) for serial in serialsList for port in portList]
+                    plan = planPortUpdates(updates)
+                    plan.report(dict(zip(serialsList, namesList)))
+                    if plan.changes:
+                        applyPortUpdates(updates, "bulk", dict(zip(serialsList, namesList)), plan=plan)
                     return serialsList, namesList
                 except Exception as e:
                     print("Invalid entries")
@@ -414,8 +540,6 @@ def changeMultPortsMultSwitches(switches, serialsList = [], namesList =[]):
 def changePortAllSwitches(switches):
     """change one single port on every single switch in the organization"""
     serialsList = []
-    threads = []
-    max_threads = 4 # only allow 4 threads to avoid hitting rate limit
     while True:
         try:
             print("This operation will change a port VLAN on EVERY SWITCH in your organization")
@@ -424,30 +548,23 @@ def changePortAllSwitches(switches):
                     return
             enteredPort = getSinglePortFromUser()  
             enteredVlan, enteredVoiceVlan = getVlansFromUser()                  
-            entry = input("Continue with the operation?(Y/N): ")
-            if entry.lower() != 'y':
-                    return
             if not enteredPort or (not enteredVlan and not enteredVoiceVlan): 
                         print("Invalid Input")
                         return
-            # to avoid hitting rate limit I divide the list of switches into four then use 4 threads
+            # work out which switches actually need the change before asking to go ahead
             for switch in switches:
                 serialsList.append(switch["serial"])
-
-            def worker(switch_chunk):
-                for serial in switch_chunk:
-                    changeVlan(enteredPort, enteredVlan, enteredVoiceVlan,"bulk", False, serial)
-                    print(".", end="")
-                    time.sleep(0.1)  # Add delay to prevent rate limiting
-
-            # divide switch list into 4 chunks then make 4 threads to perform the operations
-            switch_chunks = [serialsList[i::max_threads] for i in range(max_threads)]
-            for chunk in switch_chunks:
-                thread = threading.Thread(target=worker, args=(chunk,))
-                threads.append(thread)
-                thread.start()
-            for thread in threads:
-                thread.join()
+            updates = [(serial, enteredPort, enteredVlan, enteredVoiceVlan) for serial in serialsList]
+            switchNames = {switch["serial"]: switch["name"] for switch in switches}
+            plan = planPortUpdates(updates)
+            plan.report(switchNames)
+            if not plan.changes:
+                print("Nothing to change")
+                return
+            entry = input("Continue with the operation?(Y/N): ")
+            if entry.lower() != 'y':
+                    return
+            applyPortUpdates(updates, "bulk", switchNames, plan=plan)
             print("Operation finished, check logs to ensure all ports were successful")
             return
         except Exception as e:
@@ -456,63 +573,305 @@ def changePortAllSwitches(switches):
                 
 #---------------------------------------------------------------------------------------
 
+#---------------------------------------------------------------------------------------
+# ACTION BATCH FUNCTIONS
+ACTION_BATCH_LIMIT = 100      # max number of actions meraki allows in one asynchronous action batch
+MAX_RUNNING_BATCHES = 5       # meraki only lets an org have 5 unfinished action batches at a time
+BATCH_POLL_INTERVAL = 1       # seconds to wait between checks on a running batch
+BATCH_TIMEOUT = 300           # give up waiting on a batch after this many seconds
+
+# a voice VLAN of NO_VLAN clears it, an empty one leaves it as it is. rollbacks put back ports that had no voice VLAN with it
+NO_VLAN = "none"
+
+def rollbackVoiceVlan(voiceVlan):
+    """the voice VLAN a rollback writes for a journal entry, a port that had none has it cleared"""
+    return NO_VLAN if voiceVlan is None else voiceVlan
+
+def buildPortAction(switchSerial, portId, vlanId, voiceVlanId):
+    """builds the action batch entry that updates the vlan and voice vlan of a single port"""
+    body = {}
+    if vlanId not in (None, ""):
+        body["vlan"] = int(vlanId)
+    if voiceVlanId == NO_VLAN:
+        body["voiceVlan"] = None
+    elif voiceVlanId not in (None, ""):
+        body["voiceVlan"] = int(voiceVlanId)
+    return {"resource": f"/devices/{switchSerial}/switch/ports/{portId}", "operation": "update", "body": body}
+
+class PortPlan:
+    """What a list of (serial, port, vlan, voiceVlan) updates would actually do, worked out against the port cache.
+    only ports whose VLANs differ from what they're on now end up in changes"""
+    def __init__(self):
+        self.changes = []       # (serial, port, vlan, voiceVlan) updates that change something
+        self.unchanged = []     # (serial, port) already on the requested VLANs
+        self.missing = []       # (serial, port, reason) that can't be changed
+        self.perSwitch = {}     # serial -> [changes, unchanged, missing]
+
+    def count(self, serial, column):
+        self.perSwitch.setdefault(serial, [0, 0, 0])[column] += 1
+
+    def apiCallBudget(self):
+        """the fewest calls the changes should take and the most if every batch falls back to one call per port,
+        each batch is one call to create it and at least one to check on it"""
+        batches = -(-len(self.changes) // ACTION_BATCH_LIMIT)
+        return batches * 2, batches * 2 + len(self.changes)
+
+    def report(self, switchNames = {}):
+        """print the per switch counts and the API call estimate"""
+        for serial, (changes, unchanged, missing) in self.perSwitch.items():
+            print(f"Switch {switchNames.get(serial, serial)}: {changes} ports to change, {unchanged} already set, {missing} missing")
+        for serial, port, reason in self.missing:
+            print(f"Port {port} on switch {switchNames.get(serial, serial)} can't be changed: {reason}")
+        fewest, most = self.apiCallBudget()
+        print(f"{len(self.changes)} ports to change, {len(self.unchanged)} already set, {len(self.missing)} missing. "
+              f"Estimated API calls: {fewest} (up to {most} if batches fail)")
+
+def planPortUpdates(updates):
+    """compare the requested updates against the ports' current state read in bulk and keep only the ones that change something,
+    later updates to the same port replace earlier ones"""
+    client = currentClient()
+    plan = PortPlan()
+    try:
+        client.portInventory.loadStale([serial for serial, port, vlan, voiceVlan in updates])
+    except Exception as e:
+        print(f"\nUnable to read switch ports: {e}")
+    wanted = {}
+    for serial, port, vlan, voiceVlan in updates:
+        wanted.pop((serial, str(port).strip()), None)
+        wanted[(serial, str(port).strip())] = (vlan, voiceVlan)
+    for (serial, port), (vlan, voiceVlan) in wanted.items():
+        if serial not in client.portInventory.bySerial:
+            plan.missing.append((serial, port, "switch ports couldn't be read"))
+            plan.count(serial, 2)
+            continue
+        current = client.portInventory.getPort(serial, port)
+        if current is None:
+            plan.missing.append((serial, port, "port does not exist on this switch"))
+            plan.count(serial, 2)
+            continue
+        body = buildPortAction(serial, port, vlan, voiceVlan)["body"]
+        if not body:
+            continue
+        # a cleared voice VLAN is None in the body and missing or None on a port without one
+        if all(str(current.get(key)) == str(value) for key, value in body.items()):
+            plan.unchanged.append((serial, port))
+            plan.count(serial, 1)
+            continue
+        plan.changes.append((serial, port, vlan, voiceVlan))
+        plan.count(serial, 0)
+    return plan
+
+def submitActionBatches(actionGroups):
+    """submits groups of actions as action batches keeping up to MAX_RUNNING_BATCHES running at once,
+    the next batch is submitted as soon as any running one finishes so one slow batch doesn't hold up the rest
+    returns the indexes of the groups whose batch completed"""
+    client = currentClient()
+    succeeded = set()
+    waiting = list(range(len(actionGroups)))    # indexes of groups that haven't been submitted yet
+    running = {}                                # batch ID -> (group index, time to give up on it)
+    while waiting or running:
+        while waiting and len(running) < MAX_RUNNING_BATCHES:
+            index = waiting.pop(0)
+            try:
+                batch = client.dashboard.organizations.createOrganizationActionBatch(client.orgID, actionGroups[index], confirmed=True, synchronous=False)
+                running[batch["id"]] = (index, time.time() + BATCH_TIMEOUT)
+            except Exception as e:
+                print(f"\nFailed to submit action batch: {e}")
+            print(".", end="")
+        finished = False
+        for batchId, (index, deadline) in list(running.items()):
+            try:
+                status = client.dashboard.organizations.getOrganizationActionBatch(client.orgID, batchId).get("status", {})
+            except Exception as e:
+                # a failed poll doesn't mean the batch failed, keep asking until it times out
+                print(f"\nFailed to check action batch {batchId}: {e}")
+                status = {}
+            if status.get("completed"):
+                succeeded.add(index)
+            elif status.get("failed"):
+                print(f"\nAction batch {batchId} failed: {status.get('errors')}")
+            elif time.time() > deadline:
+                print(f"\nTimed out waiting on action batch {batchId}")
+            else:
+                continue
+            del running[batchId]
+            finished = True
+        # only wait if nothing finished, otherwise go straight back to submitting the next batches
+        if running and not finished:
+            time.sleep(BATCH_POLL_INTERVAL)
+    return succeeded
+
+@traced
+def applyPortUpdates(updates, operationType = "bulk", switchNames = {}, changeSet = None, rollback = False, plan = None):
+    """Push a list of (serial, port, vlan, voiceVlan) updates to meraki using action batches
+    only ports that aren't already on the requested VLANs are written, pass a plan from planPortUpdates to reuse one.
+    rollback data is saved for each port under one change set (a new one unless changeSet is given),
+    a rollback saves nothing. any batch that fails is retried one port at a time
+    returns a list of (serial, port) pairs that could not be changed"""
+    if changeSet is None and not rollback:
+        changeSet = newChangeSet(operationType)
+    # the rollback data comes from the port cache, any switch not already cached is read in one request
+    reported = plan is not None     # a plan that was passed in has already been shown to the user
+    if plan is None:
+        plan = planPortUpdates(updates)
+    failed = []
+    for serial, port, reason in plan.missing:
+        if not reported:
+            print(f"\nPort {port} on switch {switchNames.get(serial, serial)} can't be changed: {reason}")
+        failed.append((serial, port))
+    pending = plan.changes
+    actions = [buildPortAction(serial, port, vlan, voiceVlan) for serial, port, vlan, voiceVlan in pending]
+    if rollback:
+        return applyCheckpointedUpdates(pending, actions, failed, operationType, switchNames, changeSet, rollback)
+    # ports already on their VLANs are done, everything else is pending until it's written
+    checkpointPending(changeSet, pending)
+    checkpointDone(changeSet, plan.unchanged)
+    try:
+        return applyCheckpointedUpdates(pending, actions, failed, operationType, switchNames, changeSet, rollback)
+    except KeyboardInterrupt:
+        print(f"\nRun {changeSet} interrupted, finish it with --resume {changeSet}")
+        raise
+
+def applyCheckpointedUpdates(pending, actions, failed, operationType, switchNames, changeSet, rollback):
+    """the write half of applyPortUpdates, ports are checkpointed as done as each batch or fallback call finishes"""
+    client = currentClient()
+    # record what every port is on before anything changes, the journal writer commits them all as one group
+    rollbackIds = [None] * len(pending)
+    if not rollback:
+        rollbackIds = [saveRollbackData(operationType, serial, port, client.portInventory.getPort(serial, port).get("vlan"),
+                                        client.portInventory.getPort(serial, port).get("voiceVlan"), wait=False, changeSet=changeSet)
+                       for serial, port, vlan, voiceVlan in pending]
+        rollbackIds = [future.result() for future in rollbackIds]
+
+    actionGroups = [actions[i:i + ACTION_BATCH_LIMIT] for i in range(0, len(actions), ACTION_BATCH_LIMIT)]
+    pendingGroups = [list(zip(pending[i:i + ACTION_BATCH_LIMIT], rollbackIds[i:i + ACTION_BATCH_LIMIT])) for i in range(0, len(pending), ACTION_BATCH_LIMIT)]
+    succeeded = submitActionBatches(actionGroups)
+    if not rollback:
+        checkpointDone(changeSet, [(serial, port) for index in succeeded for (serial, port, vlan, voiceVlan), rollbackId in pendingGroups[index]])
+    fallback = {}
+    for index, group in enumerate(pendingGroups):
+        for (serial, port, vlan, voiceVlan), rollbackId in group:
+            if index not in succeeded:
+                # the port never changed so its rollback record goes, the fallback path saves its own
+                if rollbackId:
+                    removeRollbackEntryById(rollbackId)
+                fallback.setdefault((serial, vlan, voiceVlan), []).append(port)
+                continue
+            # the batch went through so log the change and update the cache
+            previous = client.portInventory.getPort(serial, port)
+            logAction("Rollback Change Set Executed" if rollback else "Changed port VLAN", serial, port,
+                      vlan or previous.get("vlan"), voiceVlan or previous.get("voiceVlan"))
+            client.portInventory.updatePort(serial, {"portId": port, **buildPortAction(serial, port, vlan, voiceVlan)["body"]})
+
+    # any batch that failed gets retried using the original one call per port path
+    for (serial, vlan, voiceVlan), portList in fallback.items():
+        print(f"\nRetrying {len(portList)} ports on switch {switchNames.get(serial, serial)} one at a time")
+        portsFailed = [str(port) for port in perPortChangePortVlan(serial, switchNames.get(serial, ""), portList, vlan, voiceVlan, changeSet, rollback)]
+        failed += [(serial, port) for port in portsFailed]
+        if not rollback:
+            checkpointDone(changeSet, [(serial, port) for port in portList if str(port) not in portsFailed])
+    return failed
+#---------------------------------------------------------------------------------------
+
 #----------------------------------------------------------------------------------------
 # SINGLE SWITCH VLAN CHANGE OPERATIONS
 
 def changeVlan(portNumber, vlanId, voiceVlanId, operationType = "single", rollback = False, switchSerial= "",switchName=""):
    """change the vlan of an individual port on a switch"""
    try:
-        # Get current port settings before making changes
-        currentSettings = dashboard.switch.getDeviceSwitchPort(serial=switchSerial, portId=portNumber)
-        previousVlan = currentSettings.get("vlan")
-        previousVoiceVlan = currentSettings.get("voiceVlan")
-        
-        # Save rollback data
-        if not rollback:
-            saveRollbackData(operationType, switchSerial, portNumber, previousVlan, previousVoiceVlan)
-            
-        # Update VLAN settings
-        if not vlanId:
-            vlanId = previousVlan
-        if not voiceVlanId:
-            voiceVlanId = previousVoiceVlan
-    
-        dashboard.switch.updateDeviceSwitchPort(
+        change = preparePortChange(portNumber, vlanId, voiceVlanId, operationType, rollback, switchSerial, switchName)
+        if not change:
+            return False
+        vlanId, voiceVlanId, previousVoiceVlan, rollbackSaved = change
+        if rollbackSaved:
+            rollbackSaved.result()  # the rollback record has to be committed before the port is changed
+        response = currentClient().dashboard.switch.updateDeviceSwitchPort(
             serial=switchSerial,
             portId=portNumber,
             vlan = vlanId,
-            voicevlan = previousVoiceVlan
+            voiceVlan = voiceVlanId
         )
-        if not rollback:
-            logAction("Changed port VLAN", switchSerial, portNumber, vlanId, voiceVlanId)
-        if not rollback and operationType == "single":
-            print("Successfully changed Switch",switchName, "port", portNumber, "to VLAN", vlanId, "and voice VLAN", voiceVlanId)
+        finishPortChange(response, portNumber, vlanId, voiceVlanId, operationType, rollback, switchSerial, switchName)
         return switchSerial, switchName
    
    except Exception as e:
         print(f"Failed Operation: {e}")
         return False
+
+async def applyPortChangeAsync(aioDashboard, change, portNumber, operationType = "bulk", rollback = False, switchSerial= "",switchName=""):
+   """makes the update for a change returned by preparePortChange through the async dashboard,
+   errors are raised rather than printed so the job queue can retry the port"""
+   vlanId, voiceVlanId, previousVoiceVlan, rollbackSaved = change
+   if rollbackSaved:
+        await asyncio.wrap_future(rollbackSaved)  # the rollback record has to be committed before the port is changed
+   response = await aioDashboard.switch.updateDeviceSwitchPort(
+        serial=switchSerial,
+        portId=portNumber,
+        vlan = vlanId,
+        voiceVlan = voiceVlanId
+   )
+   finishPortChange(response, portNumber, vlanId, voiceVlanId, operationType, rollback, switchSerial, switchName)
+   return switchSerial, switchName
+
+def preparePortChange(portNumber, vlanId, voiceVlanId, operationType, rollback, switchSerial, switchName, changeSet = None):
+    """reads the port's current settings from the cache and queues its rollback data with the journal writer,
+    under changeSet or a change set of its own,
+    returns the vlan, voice vlan and previous voice vlan to write and a future that resolves once the rollback
+    record is committed (None for rollbacks), or None if the port doesn't exist"""
+    # Get current port settings from the port cache before making changes
+    currentSettings = currentClient().portInventory.getPortState(switchSerial, portNumber)
+    if currentSettings is None:
+        print(f"Port {portNumber} not found on switch {switchName or switchSerial}")
+        return None
+    previousVlan = currentSettings.get("vlan")
+    previousVoiceVlan = currentSettings.get("voiceVlan")
+    
+    # Save rollback data
+    rollbackSaved = None
+    if not rollback:
+        rollbackSaved = saveRollbackData(operationType, switchSerial, portNumber, previousVlan, previousVoiceVlan, wait=False,
+                                         changeSet=changeSet or newChangeSet(operationType))
+        
+    # Update VLAN settings
+    if not vlanId:
+        vlanId = previousVlan
+    if voiceVlanId == NO_VLAN:
+        voiceVlanId = None  # sent as null so meraki takes the voice VLAN off the port
+    elif not voiceVlanId:
+        voiceVlanId = previousVoiceVlan
+    return vlanId, voiceVlanId, previousVoiceVlan, rollbackSaved
+
+def finishPortChange(response, portNumber, vlanId, voiceVlanId, operationType, rollback, switchSerial, switchName):
+    """stores the port's new state in the cache and logs the change"""
+    currentClient().portInventory.updatePort(switchSerial, response)
+    if not rollback:
+        logAction("Changed port VLAN", switchSerial, portNumber, vlanId, voiceVlanId)
+    if not rollback and operationType == "single":
+        print("Successfully changed Switch",switchName, "port", portNumber, "to VLAN", vlanId, "and voice VLAN", voiceVlanId)
    
 def swapPorts(port1, port2, rollBack = False,switchSerial= "",switchName=""):
     """Swap VLAN assignments between two ports on a switch."""
+    client = currentClient()
     try:
         
-        ports = dashboard.switch.getDeviceSwitchPorts(switchSerial) # get all ports on the switch
-        port1Data = next((port for port in ports if port["portId"] == port1), None) # populate port1Data with the right port
-        port2Data = next((port for port in ports if port["portId"] == port2), None) # do the same with port 2
+        port1Data = client.portInventory.getPortState(switchSerial, port1) # get port 1 from the port cache
+        port2Data = client.portInventory.getPortState(switchSerial, port2) # do the same with port 2
 
         if not port1Data or not port2Data:  # if they entered an invalid port then print that
             print("One or both ports not found.")
             return
         
         if not rollBack: # if we're not performing a rollback then save the rollback data
-            saveRollbackData('3',switchSerial, port1, port1Data.get("vlan"), port1Data.get("voiceVlan"))    #save the rollback data to the csv
-            saveRollbackData('3',switchSerial, port2, port2Data.get("vlan"), port2Data.get("voiceVlan"))
+            changeSet = newChangeSet('3')   # both halves of the swap share a change set so they can be undone together
+            saveRollbackData('3',switchSerial, port1, changeSet=changeSet)    #save the rollback data from the port cache to the journal
+            saveRollbackData('3',switchSerial, port2, changeSet=changeSet)
         
         # update port 1 with port 2's data
-        dashboard.switch.updateDeviceSwitchPort(switchSerial, port1, vlan=port2Data.get("vlan"), voiceVlan=port2Data.get("voiceVlan"))
+        response1 = client.dashboard.switch.updateDeviceSwitchPort(switchSerial, port1, vlan=port2Data.get("vlan"), voiceVlan=port2Data.get("voiceVlan"))
         # then update port 2 with port 1's data
-        dashboard.switch.updateDeviceSwitchPort(switchSerial, port2, vlan=port1Data.get("vlan"), voiceVlan=port1Data.get("voiceVlan"))
+        response2 = client.dashboard.switch.updateDeviceSwitchPort(switchSerial, port2, vlan=port1Data.get("vlan"), voiceVlan=port1Data.get("voiceVlan"))
+        client.portInventory.updatePort(switchSerial, response1)
+        client.portInventory.updatePort(switchSerial, response2)
         
         # log both actions
         logAction("Ports Swapped", switchSerial, port1, port2Data.get("vlan"), port2Data.get("voiceVlan"))
@@ -642,74 +1001,258 @@ def changeVlanPortsMenu(switches): # this menu allows for the changing of ports
 
 #---------------------------------------------------------------------------------------
 # ROLLBACK FUNCTIONS
-ROLLBACK_FILE = "rollback_data.csv"
+ROLLBACK_FILE = "rollback_data.db"
+LEGACY_ROLLBACK_FILE = "rollback_data.csv"  # rollback data written by older versions, imported into the journal on first use
+COMPACT_EVERY = 500                         # compact the journal after this many entries have been removed
+rollbackDb = None
+removedSinceCompact = 0
+
+def getRollbackDb():
+    """Open the rollback journal, a SQLite database in WAL mode, creating it on first use.
+    IDs are handed out by SQLite so they are unique even with many threads saving at once
+    and are never reused after entries are removed"""
+    global rollbackDb
+    with lock:
+        if rollbackDb is None:
+            rollbackDb = sqlite3.connect(ROLLBACK_FILE, check_same_thread=False, isolation_level=None)
+            rollbackDb.execute("PRAGMA journal_mode=WAL")
+            rollbackDb.execute("PRAGMA synchronous=FULL")  # every commit is fsynced so a saved record survives a crash
+            rollbackDb.execute("""CREATE TABLE IF NOT EXISTS rollback (
+                                      id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                      operationType TEXT,
+                                      serial TEXT,
+                                      port TEXT,
+                                      vlan INTEGER,
+                                      voiceVlan INTEGER,
+                                      deleted INTEGER NOT NULL DEFAULT 0)""")
+            rollbackDb.execute("""CREATE TABLE IF NOT EXISTS changesets (
+                                      id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                      operationType TEXT,
+                                      created TEXT)""")
+            # journals made before change sets existed don't have the column yet
+            if "changeSet" not in [column[1] for column in rollbackDb.execute("PRAGMA table_info(rollback)")]:
+                rollbackDb.execute("ALTER TABLE rollback ADD COLUMN changeSet INTEGER")
+            rollbackDb.execute("CREATE INDEX IF NOT EXISTS rollbackByChangeSet ON rollback (changeSet)")
+            # change sets remember their organization so they're rolled back or resumed against the right one
+            if "orgId" not in [column[1] for column in rollbackDb.execute("PRAGMA table_info(changesets)")]:
+                rollbackDb.execute("ALTER TABLE changesets ADD COLUMN orgId TEXT")
+            # checkpoints of each bulk run's ports, a run's ID is its change set's ID
+            rollbackDb.execute("""CREATE TABLE IF NOT EXISTS runItems (
+                                      changeSet INTEGER NOT NULL,
+                                      serial TEXT NOT NULL,
+                                      port TEXT NOT NULL,
+                                      vlan TEXT,
+                                      voiceVlan TEXT,
+                                      done INTEGER NOT NULL DEFAULT 0,
+                                      PRIMARY KEY (changeSet, serial, port))""")
+            importLegacyRollbackData(rollbackDb)
+        return rollbackDb
+
+class JournalWriter:
+    """Background thread that takes rollback records and audit log lines off a queue and commits whatever has
+    piled up as one group, one transaction and one fsync per group instead of one per port.
+    saving a rollback record returns a future that resolves to its ID once the record is durable"""
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.startLock = threading.Lock()
+
+    def start(self):
+        with self.startLock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def saveRollback(self, record):
+        """queue a (operationType, serial, port, vlan, voiceVlan, changeSet) record, returns a future for its ID"""
+        saved = concurrent.futures.Future()
+        self.start()
+        self.queue.put(("rollback", record, saved))
+        return saved
+
+    def audit(self, message):
+        """queue a line for vlanChanges.log, stamped with the time it was logged"""
+        self.start()
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
+        self.queue.put(("audit", f"{timestamp} - {message}\n", None))
+
+    def flush(self):
+        """wait until everything queued so far has been committed"""
+        done = concurrent.futures.Future()
+        self.start()
+        self.queue.put(("flush", None, done))
+        done.result()
+
+    def run(self):
+        while True:
+            group = [self.queue.get()]
+            # take everything else that's waiting so it all shares one commit
+            while True:
+                try:
+                    group.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.commit(group)
+
+    def commit(self, group):
+        rollbacks = [item for item in group if item[0] == "rollback"]
+        auditLines = [item[1] for item in group if item[0] == "audit"]
+        ids = []
+        try:
+            if rollbacks:
+                db = getRollbackDb()
+                with lock:
+                    db.execute("BEGIN IMMEDIATE")
+                    try:
+                        for kind, record, saved in rollbacks:
+                            ids.append(db.execute("INSERT INTO rollback (operationType, serial, port, vlan, voiceVlan, changeSet) VALUES (?, ?, ?, ?, ?, ?)",
+                                                  record).lastrowid)
+                        db.execute("COMMIT")
+                    except Exception:
+                        db.execute("ROLLBACK")
+                        raise
+            if auditLines:
+                with open(LOG_FILE, 'a') as logFile:
+                    logFile.writelines(auditLines)
+                    logFile.flush()
+                    os.fsync(logFile.fileno())
+        except Exception as e:
+            print(f"\nFailed to write rollback journal: {e}")
+            for kind, record, saved in group:
+                if saved and not saved.done():
+                    saved.set_exception(e)
+            return
+        for (kind, record, saved), unique_id in zip(rollbacks, ids):
+            saved.set_result(unique_id)
+        for kind, record, done in group:
+            if kind == "flush":
+                done.set_result(None)
+
+journalWriter = JournalWriter()
+# anything still queued when the script ends is committed before it exits
+atexit.register(journalWriter.flush)
+
+def importLegacyRollbackData(db):
+    """copy the rows from an old rollback_data.csv into the journal keeping their IDs, then rename the csv so it's only imported once"""
+    if not os.path.exists(LEGACY_ROLLBACK_FILE):
+        return
+    with open(LEGACY_ROLLBACK_FILE, mode='r') as file:
+        rows = [row for row in csv.reader(file) if len(row) == 6 and row[0].isdigit()]
+    db.execute("BEGIN IMMEDIATE")
+    db.executemany("INSERT OR IGNORE INTO rollback (id, operationType, serial, port, vlan, voiceVlan) VALUES (?, ?, ?, ?, ?, ?)",
+                   [(int(row[0]), row[1], row[2], row[3], toVlan(row[4]), toVlan(row[5])) for row in rows])
+    db.execute("COMMIT")
+    os.replace(LEGACY_ROLLBACK_FILE, LEGACY_ROLLBACK_FILE + ".imported")
+    print(f"Imported {len(rows)} rollback entries from {LEGACY_ROLLBACK_FILE}")
+
+def toVlan(value):
+    """converts a VLAN read from a file to an int, or None if the port had no VLAN"""
+    return int(value) if str(value).strip().isdigit() else None
+
+def newChangeSet(operationType):
+    """Start a change set, every port changed by one operation is saved under the same change set ID
+    so the whole operation can be undone at once. returns the new ID"""
+    db = getRollbackDb()
+    with lock:
+        return db.execute("INSERT INTO changesets (operationType, created, orgId) VALUES (?, ?, ?)",
+                          (operationType, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), currentClient().orgID)).lastrowid
+
+def changeSetOrg(changeSetId):
+    """the organization a change set was made in, None for sets saved before organizations were recorded"""
+    db = getRollbackDb()
+    with lock:
+        row = db.execute("SELECT orgId FROM changesets WHERE id = ?", (str(changeSetId).strip(),)).fetchone()
+    return row[0] if row else None
+
+def checkpointPending(changeSet, updates):
+    """record the (serial, port, vlan, voiceVlan) updates a run is about to make as pending"""
+    db = getRollbackDb()
+    with lock:
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany("INSERT OR REPLACE INTO runItems (changeSet, serial, port, vlan, voiceVlan, done) VALUES (?, ?, ?, ?, ?, 0)",
+                       [(changeSet, serial, str(port), str(vlan or ""), str(voiceVlan or "")) for serial, port, vlan, voiceVlan in updates])
+        db.execute("COMMIT")
+
+def checkpointDone(changeSet, ports):
+    """mark (serial, port) pairs of a run as done, once every port of the run is done its items are deleted"""
+    db = getRollbackDb()
+    with lock:
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany("UPDATE runItems SET done = 1 WHERE changeSet = ? AND serial = ? AND port = ?",
+                       [(changeSet, serial, str(port)) for serial, port in ports])
+        db.execute("DELETE FROM runItems WHERE changeSet = ? AND NOT EXISTS (SELECT 1 FROM runItems WHERE changeSet = ? AND done = 0)",
+                   (changeSet, changeSet))
+        db.execute("COMMIT")
+
+def loadPendingRun(changeSet):
+    """the (serial, port, vlan, voiceVlan) updates of a run that haven't been done yet and the run's operation type"""
+    db = getRollbackDb()
+    with lock:
+        operation = db.execute("SELECT operationType FROM changesets WHERE id = ?", (changeSet,)).fetchone()
+        updates = db.execute("SELECT serial, port, vlan, voiceVlan FROM runItems WHERE changeSet = ? AND done = 0",
+                             (changeSet,)).fetchall()
+    return (operation[0] if operation else None), updates
+
 def clearRollbackData():
-    """Clear the contents of the rollback data CSV file using csv library."""
-    with open(ROLLBACK_FILE, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow([])
+    """Clear every entry out of the rollback journal."""
+    db = getRollbackDb()
+    with lock:
+        db.execute("DELETE FROM changesets")
+        db.execute("DELETE FROM runItems")
+        db.execute("DELETE FROM rollback")
+        db.execute("VACUUM")
     print("Rollback data cleared.")
 
-def getNextRollbackId():
-    """Get the next available rollback ID."""
-    try:
-        with open(ROLLBACK_FILE, mode='r') as file:
-            reader = csv.reader(file)
-            rollbackData = list(reader)
-            if not rollbackData:
-                return 1  # Start with ID 1 if no data exists
-            last_id = int(rollbackData[-1][0])
-            return last_id + 1
-    except FileNotFoundError:
-        return 1  # Start with ID 1 if file does not exist
+def compactRollbackData():
+    """Permanently delete the entries that have been rolled back and the items of finished runs, then shrink the journal file."""
+    global removedSinceCompact
+    db = getRollbackDb()
+    with lock:
+        db.execute("DELETE FROM rollback WHERE deleted = 1")
+        db.execute("DELETE FROM runItems WHERE changeSet NOT IN (SELECT changeSet FROM runItems WHERE done = 0)")
+        db.execute("VACUUM")
+        removedSinceCompact = 0
     
 def removeRollbackEntryById(unique_id):
-    """Remove the rollback entry matching the unique ID from the CSV file."""
+    """Mark the rollback entry matching the unique ID as removed, the row is only deleted when the journal is compacted."""
+    global removedSinceCompact
+    db = getRollbackDb()
     with lock:
-        try:
-            with open(ROLLBACK_FILE, mode='r') as file:
-                reader = csv.reader(file)
-                rollbackData = list(reader)  # Read all rows into memory
-            # Filter out the entry with the matching unique ID
-            rollbackData = [row for row in rollbackData if row[0] != unique_id]
-            # Write back the filtered data
-            with open(ROLLBACK_FILE, 'w', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerows(rollbackData)  # Write remaining data
-
-        except FileNotFoundError:
-            pass  # Do nothing if file is missing
-
-# saves rollback data to a CSV file saves serial port# vlan id and voice vlan ID, called by changeVLAN
-def saveRollbackData(operationType, switchSerial, portId, vlan, voiceVlan):
-    """Save rollback data to a CSV file with a unique ID."""
-    unique_id = getNextRollbackId() 
-    with lock: 
-        with open(ROLLBACK_FILE, mode='a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow([unique_id, operationType, switchSerial, portId, vlan, voiceVlan])
-
-# loads the saved rollback data from the CSV file, called by rollbackChanges()
+        db.execute("UPDATE rollback SET deleted = 1 WHERE id = ?", (str(unique_id).strip(),))
+        removedSinceCompact += 1
+        compactNow = removedSinceCompact >= COMPACT_EVERY
+    if compactNow:
+        compactRollbackData()
+
+# saves rollback data to the journal saves serial port# vlan id and voice vlan ID, called by changeVLAN
+def saveRollbackData(operationType, switchSerial, portId, vlan = None, voiceVlan = None, wait = True, changeSet = None):
+    """Save rollback data to the journal through the journal writer, returns the unique ID it was given once it's committed
+    or with wait=False a future for that ID so many records can be committed together.
+    if no VLANs are given the port's current state is taken from the port cache"""
+    if vlan is None and voiceVlan is None:
+        previous = currentClient().portInventory.getPortState(switchSerial, portId) or {}
+        vlan, voiceVlan = previous.get("vlan"), previous.get("voiceVlan")
+    saved = journalWriter.saveRollback((operationType, switchSerial, str(portId), toVlan(vlan), toVlan(voiceVlan), changeSet))
+    return saved.result() if wait else saved
+
+# loads the saved rollback data from the journal, called by rollbackChanges()
 def loadRollbackDataById(unique_id):
-    """Load rollback data from a CSV file by unique ID."""
+    """Load rollback data from the journal by unique ID, returns None if there is no entry with that ID."""
+    db = getRollbackDb()
     with lock:
-        try:
-            with open(ROLLBACK_FILE, mode='r') as file:
-                reader = csv.reader(file)
-                for row in reader:
-                    if row and row[0] == str(unique_id):
-                        return {
-                            "unique_id": row[0],
-                            "operationType": row[1],
-                            "serial": row[2],
-                            "port": row[3],
-                            "vlan": int(row[4]),
-                            "voiceVlan": int(row[5]) if row[5].isdigit() else None
-                        }
-        except FileNotFoundError:
-            return None  # Return None if file is missing
-
-    return None  # Return None if no matching entry is found
+        row = db.execute("SELECT id, operationType, serial, port, vlan, voiceVlan FROM rollback WHERE id = ? AND deleted = 0",
+                         (str(unique_id).strip(),)).fetchone()
+    if not row:
+        return None  # Return None if no matching entry is found
+    return {
+        "unique_id": str(row[0]),
+        "operationType": row[1],
+        "serial": row[2],
+        "port": row[3],
+        "vlan": row[4],
+        "voiceVlan": row[5]
+    }
+
 # operation type 1 = port VLAN change type 2 = bulk single switchport changes
 def rollbackPortVlanById(unique_id, bulkRollback = False):
     """Rollback a port VLAN change by unique ID."""
@@ -719,7 +1262,7 @@ def rollbackPortVlanById(unique_id, bulkRollback = False):
         print("No rollback data available for the provided ID.")
         return False
     try:
-        changeVlan(rollbackData['port'], rollbackData['vlan'], rollbackData['voiceVlan'], "", True, rollbackData['serial'],)
+        changeVlan(rollbackData['port'], rollbackData['vlan'], rollbackVoiceVlan(rollbackData['voiceVlan']), "", True, rollbackData['serial'],)
         logAction("Rollback Port VLAN Executed", rollbackData['serial'], rollbackData['port'], rollbackData['vlan'], rollbackData['voiceVlan'])
         removeRollbackEntryById(unique_id)
     except Exception as e:
@@ -730,24 +1273,38 @@ def rollbackPortVlanById(unique_id, bulkRollback = False):
     return True
 
 # operation type 2, single switch bulk port change
-# multi threaded approach
+# every rollback is a job on the shared job queue
+@traced
 def bulkRollbackPortVlan(listofIds):
-    """ rollback recent port VLAN changes"""
-    max_threads = 4
-    threads = []
-    def worker(idChunk):
-        for id in idChunk:
-            rollbackPortVlanById(id, True)
-            print(".",end="")
-    idChunks = [listofIds[i::max_threads] for i in range(max_threads)]
-    
-    for chunk in idChunks:
-            thread = threading.Thread(target=worker, args=(chunk,))
-            threads.append(thread)
-            thread.start()
-            
-    for thread in threads:
-        thread.join()
+    """ rollback recent port VLAN changes. the rollback entries and every switch's ports are read before any update
+    goes out so the jobs only wait on the dashboard, an entry is removed once its port has been put back"""
+    entries = {}
+    for id in listofIds:
+        rollbackData = loadRollbackDataById(id)
+        if rollbackData:
+            entries[id] = rollbackData
+        else:
+            print(f"No rollback data available for ID {id}")
+    currentClient().portInventory.loadStale([rollbackData['serial'] for rollbackData in entries.values()])
+    changes = {}
+    for id, rollbackData in entries.items():
+        change = preparePortChange(rollbackData['port'], rollbackData['vlan'], rollbackVoiceVlan(rollbackData['voiceVlan']), "", True,
+                                   rollbackData['serial'], "")
+        if change:
+            changes[id] = change
+
+    async def rollback(aioDashboard, id):
+        await applyPortChangeAsync(aioDashboard, changes[id], entries[id]['port'], "", True, entries[id]['serial'])
+        print(".",end="")
+        return True
+
+    results = runAsync(lambda aioDashboard: runJobQueue(list(changes), lambda id: rollback(aioDashboard, id)))
+    for result in results:
+        if result.ok:
+            rollbackData = entries[result.item]
+            logAction("Rollback Port VLAN Executed", rollbackData['serial'], rollbackData['port'], rollbackData['vlan'], rollbackData['voiceVlan'])
+            removeRollbackEntryById(result.item)
+    reportJobs(results, "Rollbacks")
     print("Bulk Rollback Operation Finished")
 
 # operation type 3 - port VLAN swap
@@ -773,19 +1330,59 @@ def rollbackSwapById(unique_id1, unique_id2):
 
 def listRollbackEntries():
     """List all rollback entries with their unique IDs."""
-    try:
-        with open(ROLLBACK_FILE, mode='r') as file:
-            reader = csv.reader(file)
-            rollbackData = list(reader)  # Read all rows into memory
-        if not rollbackData:
-            print("No rollback entries found.")
-            return
-        print("Rollback Entries:")
-        for row in rollbackData:
-            print(f"ID: {row[0]}, Operation Type: {row[1]}, Switch Serial: {row[2]}, Port: {row[3]}, VLAN: {row[4]}, Voice VLAN: {row[5]}")
-
-    except FileNotFoundError:
+    db = getRollbackDb()
+    with lock:
+        rollbackData = db.execute("SELECT id, operationType, serial, port, vlan, voiceVlan, changeSet FROM rollback WHERE deleted = 0 ORDER BY id").fetchall()
+    if not rollbackData:
         print("No rollback entries found.")
+        return
+    print("Rollback Entries:")
+    for row in rollbackData:
+        print(f"ID: {row[0]}, Operation Type: {row[1]}, Switch Serial: {row[2]}, Port: {row[3]}, VLAN: {row[4] if row[4] is not None else ''}, Voice VLAN: {row[5] if row[5] is not None else ''}, Change Set: {row[6] or ''}")
+
+def listChangeSets():
+    """List every change set that still has entries that can be rolled back."""
+    db = getRollbackDb()
+    with lock:
+        changeSets = db.execute("""SELECT changesets.id, changesets.operationType, changesets.created, COUNT(rollback.id), COUNT(DISTINCT rollback.serial),
+                                   changesets.orgId
+                                   FROM changesets JOIN rollback ON rollback.changeSet = changesets.id
+                                   WHERE rollback.deleted = 0 GROUP BY changesets.id ORDER BY changesets.id""").fetchall()
+    if not changeSets:
+        print("No change sets found.")
+        return
+    print("Change Sets:")
+    for changeSet in changeSets:
+        print(f"Change Set: {changeSet[0]}, Operation Type: {changeSet[1]}, Created: {changeSet[2]}, Ports: {changeSet[3]}, Switches: {changeSet[4]}"
+              + (f", Organization: {changeSet[5]}" if changeSet[5] else ""))
+
+@traced
+def rollbackChangeSet(changeSetId):
+    """Undo a whole change set. the inverse of every change in the set is worked out from the journal in one query
+    and pushed back as a single batched write, then the set's entries are removed"""
+    db = getRollbackDb()
+    with lock:
+        rows = db.execute("SELECT id, serial, port, vlan, voiceVlan FROM rollback WHERE changeSet = ? AND deleted = 0 ORDER BY id",
+                          (str(changeSetId).strip(),)).fetchall()
+    if not rows:
+        print("No rollback data available for change set", changeSetId)
+        return False
+    # if a port was changed more than once in the set its first entry holds the state from before the set
+    inverse = {}
+    for unique_id, serial, port, vlan, voiceVlan in rows:
+        inverse.setdefault((serial, port), (vlan, rollbackVoiceVlan(voiceVlan)))
+    updates = [(serial, port, vlan, voiceVlan) for (serial, port), (vlan, voiceVlan) in inverse.items()]
+    # the action batches have to go to the organization the set was made in
+    with useClient(clientForOrg(changeSetOrg(changeSetId))):
+        failed = set(applyPortUpdates(updates, "rollback", rollback=True))
+    # only entries for ports that went back are removed so a failed port can be rolled back again later
+    with lock:
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany("UPDATE rollback SET deleted = 1 WHERE id = ?",
+                       [(unique_id,) for unique_id, serial, port, vlan, voiceVlan in rows if (serial, str(port)) not in failed])
+        db.execute("COMMIT")
+    print(f"\nChange set {changeSetId} rolled back, {len(inverse) - len(failed)} ports restored and {len(failed)} failed.")
+    return not failed
 
 # divided this into it's own menu from the rollback one because it was too big
 def bulkRollbackMenu():
@@ -799,7 +1396,7 @@ def bulkRollbackMenu():
                         entry = input("Enter a COMMA SEPERATED list of IDs: ")
                         if entry == '?':
                             dispOptions("This field takes a comma seperated list of unique IDs for a rollback change",
-                            "To find these, go to the rollback_data.csv file or select to list it to the console")
+                            "To find these, select to list the rollback entries to the console")
                             continue
                         break
                     try:
@@ -859,7 +1456,7 @@ def rollbackMenu():
     """Display the rollback menu and handle user input for rollbacks."""
     while True:
         makeMenu("ROLLBACK MENU", "1) List rollback entries", "2) Rollback a port VLAN change by ID", "3) Rollback a port swap by IDs"
-                 ,"4) Bulk rollback changes","?) View options","X) Cancel rollback operation")
+                 ,"4) Bulk rollback changes","5) List change sets","6) Rollback a whole change set","?) View options","X) Cancel rollback operation")
         selection = input("Enter your selection: ")\
         # option 1 allows the user to list all the rollback entries in the file
         if selection == '1':
@@ -870,7 +1467,7 @@ def rollbackMenu():
                 unique_id = input("Enter the ID of the port VLAN change to rollback: ")
                 if unique_id == '?':
                     dispOptions("This field take an ID for a rollback change entered as an integer",
-                    "to find these, look at rollback_data.csv or select to list the entires in the console")
+                    "to find these, select to list the rollback entries in the console")
                     continue
                 break
             if not unique_id:
@@ -888,14 +1485,14 @@ def rollbackMenu():
                 unique_id1 = input("Enter the ID of the first port swap entry: ")
                 if unique_id1 == '?':
                     dispOptions("This field take an ID for a rollback change entered as an integer",
-                    "to find these, look at rollback_data.csv or select to list the entires in the console")
+                    "to find these, select to list the rollback entries in the console")
                     continue
                 break
             while True:
                 unique_id2 = input("Enter the ID of the second port swap entry: ")
                 if unique_id2 == '?':
                     dispOptions("This field take an ID for a rollback change entered as an integer",
-                    "to find these, look at rollback_data.csv or select to list the entires in the console")
+                    "to find these, select to list the rollback entries in the console")
                     continue
                 break
             if not unique_id1 or not unique_id2:
@@ -910,9 +1507,29 @@ def rollbackMenu():
             # operation 4 opens the bulk rollback menu
         elif selection == '4':
                 bulkRollbackMenu()
-                
+        # option 5 lists the change sets, every operation's changes are saved under one change set
+        elif selection == '5':
+            listChangeSets()
+        # option 6 undoes every change in a change set with one batched write
+        elif selection == '6':
+            while True:
+                changeSetId = input("Enter the ID of the change set to rollback: ")
+                if changeSetId == '?':
+                    dispOptions("This field takes the ID of a change set entered as an integer",
+                    "to find these, select to list the change sets in the console")
+                    continue
+                break
+            if not changeSetId:
+                print("Invalid input")
+                continue
+            print("Every change in change set", changeSetId, "will be rolled back")
+            selection = input("Confirm Operation(Y/N): ")
+            if selection in('Y','y'):
+                rollbackChangeSet(changeSetId)
+            else:
+                continue
         elif selection == '?':
-                makeMenu("OPTIONS","1 - menu item 1","2 - menu item 2","? - view options","X or x - exit menu")
+                makeMenu("OPTIONS","1 - menu item 1","2 - menu item 2","3 - menu item 3","4 - menu item 4","5 - menu item 5","6 - menu item 6","? - view options","X or x - exit menu")
                 input("Press enter to continue")
         elif selection == 'X' or selection == 'x':
             return
@@ -920,17 +1537,108 @@ def rollbackMenu():
             print("Invalid selection.")
 #---------------------------------------------------------------------------------------
 
-#--------------------------------------------------------------------------------------
-# NETWORK INFO FUNCTIONS
-def getSwitches():
-    """Retrieve all switches in the organization."""
-    devices = dashboard.organizations.getOrganizationDevices(
-        orgID)  # get all organization devices
-    return [
-        device for device in devices
-        if device['productType'].startswith('switch') 
-    ]  # only return switches from response
+#---------------------------------------------------------------------------------------
+# PORT INVENTORY
+PORTS_PER_PAGE = 50         # largest page size the ports by switch endpoint accepts
+PORT_CACHE_TTL = 300        # seconds a switch's cached ports are trusted before being read again
+MAX_SERIAL_FILTER = 100     # past this many switches it's cheaper to snapshot the whole org
 
+class PortInventory:
+    """In memory snapshot of switch port configs pulled from the org wide ports by switch endpoint,
+    indexed by serial and port as well as by VLAN and voice VLAN so VLAN searches are local lookups.
+    It also serves as the port state cache that writes read their rollback data from, so entries
+    expire after PORT_CACHE_TTL and are kept current from the responses of our own writes"""
+    def __init__(self, ttl = PORT_CACHE_TTL):
+        self.ttl = ttl
+        self.bySerial = {}      # serial -> {portId: port}
+        self.byVlan = {}        # vlan -> {serial: [portIds]}
+        self.byVoiceVlan = {}   # voice vlan -> {serial: [portIds]}
+        self.loadedAt = {}      # serial -> time the switch was last read
+        self.lock = threading.RLock()
+
+    def load(self, serials = None):
+        """pull port configs for every switch in the org, or only the serials given, in a few paginated requests"""
+        client = currentClient()
+        kwargs = {"perPage": PORTS_PER_PAGE}
+        if serials and len(serials) <= MAX_SERIAL_FILTER:
+            kwargs["serials"] = list(serials)
+        switches = client.dashboard.switch.getOrganizationSwitchPortsBySwitch(client.orgID, total_pages='all', **kwargs)
+        with self.lock:
+            for switch in switches:
+                self._indexSwitch(switch["serial"], switch.get("ports", []))
+        return len(switches)
+
+    def loadStale(self, serials):
+        """load only the switches that aren't cached or have expired"""
+        stale = [serial for serial in dict.fromkeys(serials) if not self.hasSwitch(serial)]
+        if stale:
+            self.load(stale)
+
+    def _indexSwitch(self, serial, ports):
+        """replace everything known about one switch with a fresh list of its ports"""
+        self._dropSwitch(serial)
+        self.bySerial[serial] = {}
+        self.loadedAt[serial] = time.time()
+        for port in ports:
+            self._indexPort(serial, port)
+
+    def _indexPort(self, serial, port):
+        portId = str(port["portId"])
+        self.bySerial[serial][portId] = port
+        self.byVlan.setdefault(str(port.get("vlan")), {}).setdefault(serial, []).append(portId)
+        self.byVoiceVlan.setdefault(str(port.get("voiceVlan")), {}).setdefault(serial, []).append(portId)
+
+    def _dropSwitch(self, serial):
+        """remove a switch from every index"""
+        self.bySerial.pop(serial, None)
+        self.loadedAt.pop(serial, None)
+        for index in (self.byVlan, self.byVoiceVlan):
+            for vlanPorts in index.values():
+                vlanPorts.pop(serial, None)
+
+    def updatePort(self, serial, port):
+        """store the new state of a port after we've written to it, the port's VLAN indexes move with it"""
+        with self.lock:
+            if serial not in self.bySerial:
+                return
+            portId = str(port["portId"])
+            previous = self.bySerial[serial].get(portId)
+            if previous:
+                for index, key in ((self.byVlan, "vlan"), (self.byVoiceVlan, "voiceVlan")):
+                    vlanPorts = index.get(str(previous.get(key)), {}).get(serial, [])
+                    if portId in vlanPorts:
+                        vlanPorts.remove(portId)
+                port = {**previous, **port}
+            self._indexPort(serial, port)
+
+    def invalidate(self, serial = None):
+        """drop one switch, or every switch if no serial is given, so the next lookup reads it from meraki again"""
+        with self.lock:
+            if serial is None:
+                self.bySerial.clear()
+                self.byVlan.clear()
+                self.byVoiceVlan.clear()
+                self.loadedAt.clear()
+            else:
+                self._dropSwitch(serial)
+
+    def hasSwitch(self, serial):
+        """true if the switch is cached and hasn't expired"""
+        return serial in self.bySerial and time.time() - self.loadedAt.get(serial, 0) < self.ttl
+
+    def getPort(self, serial, portId):
+        """returns the port config for a port on a switch or None if it isn't in the snapshot"""
+        return self.bySerial.get(serial, {}).get(str(portId))
+
+    def getPortState(self, serial, portId):
+        """returns the current config of a port, reading the switch first if it isn't cached or has expired"""
+        self.loadStale([serial])
+        return self.getPort(serial, portId)
+
+    def portsOnVlan(self, serial, vlanId, voiceBool = False):
+        """returns the ports on a switch that are on a VLAN, or voice VLAN if voiceBool is set"""
+        index = self.byVoiceVlan if voiceBool else self.byVlan
+        return list(index.get(str(vlanId), {}).get(serial, []))
 
 #-------------------------------------------------------------------------------------
 #INTRODUCTION 
@@ -993,13 +1701,11 @@ def getSingleVlanFromUser():
             return vlanID, voiceBool
         
 def getPortsonVLAN(serial, vlanId, voiceBool):
-    """Returns all ports on a specific VLAN or voice VLAN, using voiceBool to tell which it should be searching for"""
-    ports = dashboard.switch.getDeviceSwitchPorts(serial)
-    if not voiceBool:
-        vlanPorts = [port["portId"] for port in ports if str(port.get("vlan")) == str(vlanId)]
-    else:
-        vlanPorts = [port["portId"] for port in ports if str(port.get("voiceVlan")) == str(vlanId)]
-    return vlanPorts
+    """Returns all ports on a specific VLAN or voice VLAN, using voiceBool to tell which it should be searching for
+    switches missing from the port inventory are pulled into it first"""
+    client = currentClient()
+    client.portInventory.loadStale([serial])
+    return client.portInventory.portsOnVlan(serial, vlanId, voiceBool)
 
 
 def singleSwitchChangebyVLAN(switches, serial = "", switchName = ""):
@@ -1025,6 +1731,8 @@ def multiSwitchChangeByVLAN(switches, serialsList = [], namesList = []):
             serialsList,namesList = getListOfSerialsFromUser(switches)
         vlanID,voiceBool = getSingleVlanFromUser()
         vlanID2, voicevlan = getVlansFromUser()
+        # snapshot every selected switch in one request so the searches below don't each hit the API
+        currentClient().portInventory.load(serialsList)
         for serial in serialsList:
             portLists.append(getPortsonVLAN(serial,vlanID,voiceBool))
         while True:
@@ -1038,8 +1746,9 @@ def multiSwitchChangeByVLAN(switches, serialsList = [], namesList = []):
                                 continue
                             else:
                                 return serialsList, namesList
-            for serial, name, portList in zip(serialsList, namesList,portLists):
-                bulkChangePortVlan(serial,name,portList,vlanID2, voicevlan)
+            # every switch's ports go out together so they share action batches and one change set
+            updates = [(serial, port, vlanID2, voicevlan) for serial, portList in zip(serialsList, portLists) for port in portList]
+            applyPortUpdates(updates, "bulk", dict(zip(serialsList, namesList)))
             return serialsList, namesList
 
 def everySwitchChangeByVLAN(switches):
@@ -1051,11 +1760,16 @@ def everySwitchChangeByVLAN(switches):
         print("Operation cancelled")
         return
     vlanID,voiceBool = getSingleVlanFromUser()
+    # snapshot the whole org in a few paginated requests instead of reading every switch one at a time
+    currentClient().portInventory.load()
     for switch in switches:
         portLists.append(getPortsonVLAN(switch['serial'],vlanID,voiceBool))
     vlanID2, voicevlan = getVlansFromUser()
-    for switch, portList in zip(switches,portLists):
-        bulkChangePortVlan(switch['serial'],switch['name'],portList,vlanID2, voicevlan)
+    # every switch's ports go out together so they share action batches and one change set
+    updates = [(switch['serial'], port, vlanID2, voicevlan) for switch, portList in zip(switches, portLists) for port in portList]
+    plan = planPortUpdates(updates)
+    failed = applyPortUpdates(updates, "bulk", {switch['serial']: switch['name'] for switch in switches}, plan=plan)
+    print(f"\nChanged {len(plan.changes) - len(failed)} ports across {len(switches)} switches, {len(plan.unchanged)} already set, {len(failed)} failed")
 
 def bulkChangeVlansbyVlanMenu(switches):
     """menu used to handle bulk VLAN change operations"""
@@ -1099,15 +1813,315 @@ def bulkChangeVlansbyVlanMenu(switches):
         except Exception as e:
             print("Invalid entries", e)
 
+#---------------------------------------------------------------------------------------------
+# PLAN FILES
+PLAN_COLUMNS = ("switch", "ports", "vlan", "voiceVlan", "org")    # org is only needed when a switch name is in more than one organization
+PLAN_CHUNK = ACTION_BATCH_LIMIT * MAX_RUNNING_BATCHES   # ports pushed between progress reports, one full window of action batches
+
+def parsePortList(ports):
+    """turns a plan's ports into a list of port IDs, ports can be a list or a string like 1-4,7,9"""
+    if isinstance(ports, int):
+        return [str(ports)]
+    if isinstance(ports, str):
+        ports = ports.split(',')
+    portList = []
+    for entry in ports:
+        entry = str(entry).strip()
+        if not entry:
+            continue
+        if re.fullmatch(r"\d+\s*-\s*\d+", entry):
+            start, end = (int(part) for part in entry.split('-'))
+            portList.extend(str(port) for port in range(start, end + 1))
+        else:
+            portList.append(entry)
+    return portList
+
+def readPlan(planFile):
+    """reads a plan of (switch, ports, vlan, voiceVlan) rows from a CSV, JSON or YAML file
+    JSON and YAML plans are a list of rows or a mapping with the rows under changes"""
+    extension = os.path.splitext(planFile)[1].lower()
+    with open(planFile, "r", newline="") as file:
+        if extension == ".csv":
+            return list(csv.DictReader(file))
+        if extension == ".json":
+            plan = json.load(file)
+        elif extension in (".yaml", ".yml"):
+            try:
+                import yaml # type: ignore
+            except ImportError:
+                raise ValueError("YAML plans need the pyyaml package, install it or use a CSV or JSON plan")
+            plan = yaml.safe_load(file)
+        else:
+            raise ValueError(f"Unknown plan format {extension}, use .csv, .json or .yaml")
+    if isinstance(plan, dict):
+        plan = plan.get("changes", [])
+    if not isinstance(plan, list):
+        raise ValueError("A plan must be a list of changes")
+    return plan
+
+def findPlanSwitch(switches, switchEntry):
+    """the serial of the switch a plan row names by its serial or its whole name, None if it isn't in switches.
+    unlike the menus a plan runs unattended so a prefix or typo never picks a switch, only case is ignored"""
+    switch = switches.bySerialNumber(switchEntry) if is_serial_number(switchEntry.upper()) else None
+    switch = switch or switches.byExactName(switchEntry)
+    return switch['serial'] if switch else None
+
+def validatePlan(plan, switches, rowNumbers = None):
+    """checks every row of a plan against the switch and port inventory before anything is changed
+    rows for the same port are coalesced with later rows winning, returns the (serial, port, vlan, voiceVlan)
+    updates grouped by switch along with a list of every problem found. rowNumbers are the rows' numbers in the plan file
+    when plan is only part of it"""
+    client = currentClient()
+    switches = indexSwitches(switches)
+    errors = []
+    rows = []
+    for number, row in zip(rowNumbers or itertools.count(1), plan):
+        if not isinstance(row, dict) or not row.get("switch"):
+            errors.append(f"Row {number}: no switch given")
+            continue
+        switchEntry = str(row["switch"]).strip()
+        serial = findPlanSwitch(switches, switchEntry)
+        if not serial:
+            suggestions = switches.closestNames(switchEntry)
+            errors.append(f"Row {number}: no switch {switchEntry} found" + (f", did you mean {', '.join(suggestions)}" if suggestions else ""))
+            continue
+        vlans = []
+        for column in ("vlan", "voiceVlan"):
+            value = row.get(column)
+            value = "" if value is None else str(value).strip()
+            if value and (not value.isdigit() or not 1 <= int(value) <= 4094):
+                errors.append(f"Row {number}: {column} {value} is not a VLAN ID between 1 and 4094")
+                value = None
+            vlans.append(value)
+        if None in vlans:
+            continue
+        if not any(vlans):
+            errors.append(f"Row {number}: no vlan or voiceVlan given")
+            continue
+        portList = parsePortList(row.get("ports") or [])
+        if not portList:
+            errors.append(f"Row {number}: no ports given")
+            continue
+        rows.append((number, serial, portList, vlans[0], vlans[1]))
+
+    # every switch in the plan is read in one request so the ports can be checked locally,
+    # with no valid rows there's nothing to read and load() with no serials would read the whole org
+    if rows:
+        client.portInventory.load(list({serial for number, serial, portList, vlan, voiceVlan in rows}))
+    coalesced = {}
+    for number, serial, portList, vlan, voiceVlan in rows:
+        for port in portList:
+            if client.portInventory.getPort(serial, port) is None:
+                errors.append(f"Row {number}: port {port} does not exist on switch {getNameBySerial(switches, serial)}")
+                continue
+            previous = coalesced.pop((serial, port), ("", ""))
+            # a later row only overrides the VLANs it sets so a vlan row and a voiceVlan row for a port combine
+            coalesced[(serial, port)] = (vlan or previous[0], voiceVlan or previous[1])
+    updates = sorted(((serial, port, vlan, voiceVlan) for (serial, port), (vlan, voiceVlan) in coalesced.items()),
+                     key=lambda update: (update[0], int(update[1]) if update[1].isdigit() else float('inf')))
+    return updates, errors
+
+def assignPlanRows(plan, clients):
+    """works out which organization each plan row is for, from its org column (a name or ID) or else the one
+    selected organization that has its switch. returns a dict of client to its (row number, row) pairs and a list
+    of the rows that couldn't be placed"""
+    if len(clients) == 1:
+        return {clients[0]: list(enumerate(plan, start=1))}, []
+    byKey = {}
+    for client in clients:
+        byKey[str(client.orgID)] = client
+        byKey.setdefault(str(client.orgName).lower(), client)
+    assigned = {client: [] for client in clients}
+    errors = []
+    for number, row in enumerate(plan, start=1):
+        if not isinstance(row, dict) or not row.get("switch"):
+            errors.append(f"Row {number}: no switch given")
+            continue
+        orgEntry = str(row.get("org") or "").strip()
+        switchEntry = str(row["switch"]).strip()
+        if orgEntry:
+            owners = [byKey[key] for key in (orgEntry, orgEntry.lower()) if key in byKey][:1]
+            if not owners:
+                errors.append(f"Row {number}: organization {orgEntry} isn't one of the selected organizations")
+                continue
+        else:
+            owners = [client for client in clients if findPlanSwitch(client.switches, switchEntry)]
+            if not owners:
+                suggestions = [name for client in clients for name in client.switches.closestNames(switchEntry)]
+                errors.append(f"Row {number}: no switch {switchEntry} found in any selected organization"
+                              + (f", did you mean {', '.join(suggestions)}" if suggestions else ""))
+                continue
+            if len(owners) > 1:
+                errors.append(f"Row {number}: switch {switchEntry} is in {', '.join(str(client.orgName) for client in owners)}, "
+                              "add an org column to pick one")
+                continue
+        assigned[owners[0]].append((number, row))
+    return {client: rows for client, rows in assigned.items() if rows}, errors
+
+def switchNamesOf(client):
+    """serial -> name for a client's switches"""
+    return {switch['serial']: switch['name'] for switch in client.switches}
+
+@traced
+def runPlan(planFile, clients, assumeYes = False, dryRun = False):
+    """validate a plan file and push it through the action batch engine, returns the exit code for the script.
+    the rows are split between the selected organizations, each is checked and changed in parallel with the others
+    under its own rate limit. a dry run only reports what would change"""
+    try:
+        plan = readPlan(planFile)
+    except (OSError, ValueError) as e:
+        print(f"Unable to read plan {planFile}: {e}")
+        return 2
+    assigned, errors = assignPlanRows(plan, clients)
+
+    def prepareOrg():
+        """validate this org's rows and keep the ports that actually change"""
+        rows = assigned[currentClient()]
+        updates, orgErrors = validatePlan([row for number, row in rows], currentClient().switches, [number for number, row in rows])
+        # ports already on the planned VLANs are dropped so a rerun after a partial failure only does what's left
+        return updates, orgErrors, (planPortUpdates(updates) if updates and not orgErrors else None)
+    prepared = runAcrossOrgs(list(assigned), prepareOrg)
+    for client, result in prepared.items():
+        if isinstance(result, Exception):
+            errors.append(f"Organization {client.orgName}: {result}")
+        else:
+            errors += result[1]
+    if errors:
+        print(f"Plan {planFile} has {len(errors)} problems, nothing was changed:")
+        for error in errors:
+            print(" ", error)
+        return 2
+    updates = [update for result in prepared.values() for update in result[0]]
+    if not updates:
+        print("The plan has no changes")
+        return 0
+    print(f"Plan {planFile}: {len(updates)} ports on {len({update[0] for update in updates})} switches from {len(plan)} rows"
+          + (f" in {len(prepared)} organizations" if len(prepared) > 1 else ""))
+    changes = {}
+    for client, (orgUpdates, orgErrors, portPlan) in prepared.items():
+        if len(prepared) > 1:
+            print(f"Organization {client.orgName}:")
+        portPlan.report(switchNamesOf(client))
+        if portPlan.changes:
+            changes[client] = portPlan.changes
+    if dryRun or not changes:
+        return 0
+    if not assumeYes and input("Confirm Operation(Y/N): ") not in ('Y', 'y'):
+        print("Plan cancelled")
+        return 1
+
+    def applyOrg():
+        """each org's part of the plan is one change set so it can be rolled back or resumed in that org in one go"""
+        changeSet = newChangeSet("plan")
+        return changeSet, applyWithProgress(changes[currentClient()], "plan", switchNamesOf(currentClient()), changeSet)
+    results = runAcrossOrgs(list(changes), applyOrg)
+    if len(results) > 1:
+        print("\nPlan results by organization:")
+    exitCode = 0
+    for client, result in results.items():
+        if isinstance(result, Exception):
+            print(f"{client.orgName}: stopped, {result}")
+            exitCode = 1
+            continue
+        changeSet, failed = result
+        if len(results) > 1:
+            print(f"{client.orgName}: run {changeSet}, {len(changes[client]) - len(failed)} ports changed, {len(failed)} failed")
+        if failed:
+            exitCode = 1
+    return exitCode
+
+def applyWithProgress(updates, operationType, switchNames, changeSet):
+    """push updates a window of batches at a time, reporting progress after each, returns the (serial, port) pairs that failed"""
+    # every port is checkpointed up front so an interrupted run can be resumed even before its later windows start
+    checkpointPending(changeSet, updates)
+    failed = []
+    for start in range(0, len(updates), PLAN_CHUNK):
+        if stopRequested.is_set():
+            print(f"\nRun {changeSet} in {currentClient().orgName} stopped, finish it with --resume {changeSet}")
+            raise RunStopped(f"finish it with --resume {changeSet}")
+        failed += applyPortUpdates(updates[start:start + PLAN_CHUNK], operationType, switchNames, changeSet)
+        done = min(start + PLAN_CHUNK, len(updates))
+        print(f"\nProgress: {done}/{len(updates)} ports ({done * 100 // len(updates)}%), {len(failed)} failed")
+    for serial, port in failed:
+        print(f"Failed to change port {port} on switch {switchNames.get(serial, serial)}")
+    print(f"Run {changeSet} finished, {len(updates) - len(failed)} ports changed")
+    if failed:
+        print(f"Retry the failed ports with --resume {changeSet}")
+    return failed
+
+@traced
+def resumeRun(runId, assumeYes = False):
+    """carry on with a bulk run that was interrupted or had failures, only ports not yet done are sent.
+    the remaining ports are saved under the run's change set so rolling it back still undoes the whole run.
+    the run is finished in the organization it was started in"""
+    operationType, updates = loadPendingRun(runId)
+    if operationType is None:
+        print(f"No run {runId} found")
+        return 2
+    if not updates:
+        print(f"Run {runId} has nothing left to do")
+        return 0
+    with useClient(clientForOrg(changeSetOrg(runId))) as client:
+        if client.switches is None:
+            client.switches = SwitchIndex(getSwitches(client))
+        switchNames = switchNamesOf(client)
+        # read the ports fresh, anything the interrupted run managed to write before stopping shows up as already set
+        client.portInventory.load(list({serial for serial, port, vlan, voiceVlan in updates}))
+        portPlan = planPortUpdates(updates)
+        portPlan.report(switchNames)
+        checkpointDone(runId, portPlan.unchanged)
+        if not portPlan.changes:
+            return 0
+        if not assumeYes and input("Confirm Operation(Y/N): ") not in ('Y', 'y'):
+            print("Resume cancelled")
+            return 1
+        return 1 if applyWithProgress(portPlan.changes, operationType, switchNames, runId) else 0
+
+def parseArguments():
+    """command line options, with no plan the interactive menus are used"""
+    parser = argparse.ArgumentParser(description="Change the VLANs of Meraki switch ports, interactively or from a plan file")
+    parser.add_argument("--plan", metavar="FILE", help="CSV, JSON or YAML file of switch, ports, vlan, voiceVlan rows to apply without the menus")
+    parser.add_argument("--yes", action="store_true", help="don't ask for confirmation before applying a plan")
+    parser.add_argument("--resume", metavar="RUN_ID", type=int, help="finish the ports an interrupted or partly failed bulk run didn't get to")
+    parser.add_argument("--metrics", metavar="FILE", help="save per endpoint API call metrics and operation spans when the script ends, "
+                        "as prometheus text for a .prom file or JSON otherwise")
+    parser.add_argument("--org", metavar="ORGS", help="organizations to work on, names or IDs separated by commas or all. "
+                        "defaults to the first organization the key can see")
+    parser.add_argument("--dry-run", action="store_true", help="show what a plan would change and how many API calls it needs without changing anything")
+    return parser.parse_args()
+
+def readApiKey():
+    """the API key for unattended runs, from MERAKI_DASHBOARD_API_KEY or the key file, never prompts"""
+    global KEY_FILE
+    KEY_FILE = "vlanScriptKey.txt"
+    if os.environ.get("MERAKI_DASHBOARD_API_KEY"):
+        return os.environ["MERAKI_DASHBOARD_API_KEY"].strip()
+    if os.path.exists(KEY_FILE):
+        with open(KEY_FILE, "r") as file:
+            return file.read().strip()
+    return ""
+#---------------------------------------------------------------------------------------------
+
 #---------------------------------------------------------------------------------------------
 # MAIN MENU
+def chooseOrganization(clients):
+    """the menus work on one organization at a time, when more than one was selected ask which"""
+    if len(clients) == 1:
+        return clients[0]
+    while True:
+        makeMenu("ORGANIZATIONS", *[f"{number}) {client.orgName}" for number, client in enumerate(clients, start=1)])
+        choice = input("Enter the organization to work on: ").strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(clients):
+            return clients[int(choice) - 1]
+        print("Invalid selection.")
+
 def menu(switches):
     """main menu that allows navigation to the other main functions of the script"""
     print("WELCOME TO THE MERAKI SWITCHPORT VLAN MANAGER")
     while True:
         makeMenu("MAIN MENU", "1) Change port VLAN Assignments by VLAN",
                 "2) Change port VLAN Assignments by PORT",
-                "3) Rollback Changes", "4) Clear generated files", "?) View options", "X) End script")
+                "3) Rollback Changes", "4) Clear generated files", "5) Refresh cached switches and ports", "?) View options", "X) End script")
         choice = input("Enter your choice: ") 
         if choice == '1':           # choice 1 is for changing VLANs by VLAN
             bulkChangeVlansbyVlanMenu(switches)
@@ -1118,12 +2132,12 @@ def menu(switches):
             rollbackMenu()
             continue
         elif choice == '4':        # choice E allows the user to clear out any files generated by the script
-            makeMenu("CLEAR GENERATED FILES MENU", "1) Clear the vlanChanges.log file","2) Clear the rollback_data.csv file(ENSURE YOU DON'T NEED THIS DATA)",
+            makeMenu("CLEAR GENERATED FILES MENU", "1) Clear the vlanChanges.log file","2) Clear the rollback_data.db journal(ENSURE YOU DON'T NEED THIS DATA)",
                      "3) Clear both files(ENSURE YOU DON'T NEED THIS DATA)","X) Go Back")
             selection = input("Enter your choice: ")
             if selection == '1':            # option 1 clears the vlanChanges.log file
                 clearVlanLog()
-            elif selection == '2':          # option 2 clears the rollback_data.csv file
+            elif selection == '2':          # option 2 clears the rollback_data.db journal
                 clearRollbackData()
             elif selection == '3':          # option 3 clears both files
                 clearVlanLog()
@@ -1133,6 +2147,11 @@ def menu(switches):
             else:
                 print("Invalid entry")
             continue
+        elif choice == '5':        # choice 5 downloads the switch list again and throws away the cached port states
+            switches = currentClient().switches = SwitchIndex(getSwitches(currentClient(), refresh=True))
+            currentClient().portInventory.invalidate()
+            print(f"Switch list refreshed, {len(switches)} switches found. Cached ports will be read again on the next operation.")
+            continue
         elif choice == '?':
                 makeMenu("OPTIONS","1 - menu item 1","2 - menu item 2","3 - menu item 3","4 - menu item 4","5 - menu item 5","? - view options","X or x - exit menu")
                 input("Press enter to continue")
@@ -1145,10 +2164,18 @@ def menu(switches):
 #--------------------------------------------------------------------------------------------------
 
 def main():
-    global API_KEY
+    args = parseArguments()
+    if args.metrics:
+        atexit.register(callMetrics.save, os.path.abspath(args.metrics))
     while True:
-        API_KEY = introduction()
-        if not API_KEY: # if there is no valid API key   
+        if args.plan or args.resume:
+            apiKey = readApiKey()
+            if not apiKey:
+                print("No API key, set MERAKI_DASHBOARD_API_KEY or put the key in vlanScriptKey.txt")
+                sys.exit(2)
+            break
+        apiKey = introduction()
+        if not apiKey: # if there is no valid API key   
             print("No valid API Key, check vlanScriptKey.txt(should contain ONLY the API key)")
             if os.path.exists(KEY_FILE): 
                 os.remove(KEY_FILE)
@@ -1156,20 +2183,42 @@ def main():
         else:
             break
     
-    global dashboard 
-    global orgID
     try:
-        dashboard = meraki.DashboardAPI(API_KEY, output_log=False,print_console=False,suppress_logging=True)  # open dashboard
+        client = MerakiClient(apiKey)  # open dashboard
     except Exception as e:
         print ("Failed to connect with dashboard, ending script...")
         return # display an error and end the script
     try:
-        orgID = getOrgID()  # get the orgID
+        allOrgs = client.getOrganizations()  # get organizations list
+        orgs = selectOrganizations(allOrgs, args.org)
+    except ValueError as e:
+        print(e)
+        return
     except Exception as e:
         print("Unable to get org ID, ending script...")
         return
-    switches = getSwitches() # get all switches and store them in a list   
-    menu(switches)
+    if not orgs:
+        print("Unable to get org ID, ending script...")
+        return
+    if not args.org and len(allOrgs) > 1:
+        print(f"Using organization {orgs[0].get('name')}, the key can see {len(allOrgs)}. Pick others with --org")
+    # the first org reuses the dashboard already open, every other org gets a client and rate limit of its own
+    client.orgID, client.orgName = orgs[0]['id'], orgs[0].get('name')
+    clients = [client] + [client.forOrganization(org) for org in orgs[1:]]
+    activeClient.set(client)
+    if args.resume:
+        sys.exit(resumeRun(args.resume, args.yes))
+    # get all switches of every org at once and index them by serial and name
+    for orgClient, switches in runAcrossOrgs(clients, lambda: SwitchIndex(getSwitches(currentClient()))).items():
+        if isinstance(switches, Exception):
+            print(f"Unable to get the switches of {orgClient.orgName}: {switches}")
+            return
+        orgClient.switches = switches
+    if args.plan:
+        sys.exit(runPlan(args.plan, clients, args.yes, args.dry_run))
+    client = chooseOrganization(clients)
+    activeClient.set(client)
+    menu(client.switches)
 
 if __name__ == "__main__":
     main()
@@ -1,37 +1,29 @@
 from datetime import datetime
-import importlib.metadata
+import importlib.util
+import argparse
+import bisect
+import concurrent.futures
+import csv
+import heapq
+import json
 import os
+import queue
+import re
+import sqlite3
 import threading
-import subprocess
-import sys
 import time
 import webbrowser
-import concurrent.futures
+import asyncio
+import atexit
 #from queue import Queue
 from pathlib import Path
-#global thread lock used to prevent race condition when writing to the file
-file_lock = threading.Lock()
-api_semaphore = threading.Semaphore(10)  # semaphore to limit API calls
-# make sure that meraki is installed by first declaring a list of external libraries required
-required = {'meraki'}
-# then get a list of installed packages
-installed = {pkg.metadata['Name'] for pkg in importlib.metadata.distributions()}
-# find what's missing by subtracting what's installed from what's required
-missing = required - installed
-# if anything is missing install it via pip
-if missing:
-    subprocess.check_call([sys.executable, '-m', 'pip', 'install', *missing])
-# now that we can sure sure meraki is installed import the library
-import meraki
-
-def getSwitches(orgID):
-    # Retrieve all switches in the organization.
-    devices = dashboard.organizations.getOrganizationDevices(
-        orgID)  # get all organization devices
-    return [
-        device for device in devices
-        if device['productType'].startswith('switch')
-    ]  
+from merakiCommon import (MAX_CONCURRENT_REQUESTS, ThrottledDashboard,
+                          callMetrics, traced, runJobQueue, reportJobs,
+                          MerakiClient, activeClient, currentClient, selectOrganizations,
+                          SWITCH_CACHE_FILE, getSwitches)
+CLIENT_TIMESPAN = 86400         # seconds of client history asked for, meraki's default is one day
+MAX_CLIENT_TIMESPAN = 2678400   # meraki won't go back further than 31 days
+CLIENTS_PER_PAGE = 1000         # page size for the network clients endpoint, meraki allows 3 to 5000
 
 def getOutputDir():
      # Create output_files directory if it doesn't exist
@@ -39,43 +31,609 @@ def getOutputDir():
     os.makedirs(output_dir, exist_ok=True)
     return output_dir
 
-def getOrgID():
-    # Get the orgID from meraki dashboard
-    orgs = dashboard.organizations.getOrganizations()  # get organizations list
-    return orgs[0]['id'] if orgs else None  # return the ID from that list
+def switchCacheFile(client):
+    """the org's cached switch list, kept in the output directory"""
+    return os.path.join(getOutputDir(), SWITCH_CACHE_FILE.format(client.orgID))
+
+def runAcrossOrgs(clients, operation):
+    """runs operation(aioDashboard) for every client at once on one event loop, each org in a task of its own with its
+    client current so it gets that org's async dashboard and rate limiter.
+    returns a dict of client to what operation returned, or to the exception it raised so one org failing doesn't stop the rest"""
+    async def runOrg(client):
+        activeClient.set(client)    # every task runs in its own copy of the context so this only affects this org
+        async with client.openAsyncDashboard() as aioDashboard:
+            return await operation(ThrottledDashboard(aioDashboard, client.rateLimiter, asyncMode = True))
+    async def main():
+        return await asyncio.gather(*(runOrg(client) for client in clients), return_exceptions=True)
+    return dict(zip(clients, asyncio.run(main())))
+
+def mergeOrgResults(results):
+    """joins the job results of every org into one list, orgs that failed outright are printed"""
+    merged = []
+    for client, result in results.items():
+        if isinstance(result, Exception):
+            print(f"Failed to read organization {client.orgName}: {result}")
+        else:
+            merged += result
+    return merged
+
+async def streamClients(aioDashboard, serial = None, networkId = None, timespan = CLIENT_TIMESPAN):
+    """yields the clients seen on a switch or a network over the last timespan seconds one at a time.
+    network clients are read a page at a time with each page going through the rate limiter, so the first
+    clients are handed on before the rest are downloaded and only a page or two is held in memory.
+    the switch clients endpoint isn't paginated so a switch's clients arrive in one response"""
+    if serial:
+        for client in await aioDashboard.devices.getDeviceClients(serial, timespan=timespan):
+            yield client
+        return
+    # the async dashboard pages with an iterator so the SDK follows meraki's Link headers to the next page
+    async for client in aioDashboard.networks.getNetworkClients(networkId, timespan=timespan, perPage=CLIENTS_PER_PAGE, total_pages='all'):
+        yield client
+
+async def filterClients(clients, *predicates):
+    """pipeline stage that passes on only the clients every predicate accepts"""
+    async for client in clients:
+        if all(predicate(client) for predicate in predicates):
+            yield client
+
+#-------------------------------------------------------------------------------------
+# CLIENT FILTERS
+# each profile is a list of alternatives, a client matches if every condition in any one alternative matches.
+# a condition is field=values where values are comma separated, description matches name prefixes,
+# mac matches MAC or OUI prefixes and vlan and port match numbers or ranges like 100-199
+CLIENT_PROFILES = {
+    "phones": [["description=SEP"]],
+    "voip": [["description=SEP"], ["mac=00:04:f2,64:16:7f"], ["mac=00:15:65,80:5e:c0"]],   # Cisco, Polycom and Yealink
+    "cameras": [["mac=00:40:8c,ac:cc:8e,b8:a4:4f"]],                                       # Axis
+    "printers": [["description=NPI,BRN,BRW,EPSON,HP"]],
+    "aps": [["description=AP"]],
+}
+
+def compilePrefixes(values):
+    """name prefixes, str.startswith with a tuple checks them all in one call"""
+    prefixes = tuple(values)
+    def matches(client):
+        return (client.get('description') or '').startswith(prefixes)
+    return matches
+
+def compileMacPrefixes(values):
+    """MAC or OUI prefixes in a trie of hex digits so a lookup is at most 12 steps however many prefixes there are"""
+    trie = {}
+    for value in values:
+        node = trie
+        for digit in re.sub(r"[^0-9a-f]", "", value.lower()):
+            node = node.setdefault(digit, {})
+        node[""] = True     # a prefix ends here
+    def matches(client):
+        node = trie
+        for digit in re.sub(r"[^0-9a-f]", "", (client.get('mac') or '').lower()):
+            if "" in node:
+                return True
+            node = node.get(digit)
+            if node is None:
+                return False
+        return "" in node
+    return matches
+
+def compileRanges(field, values):
+    """numbers and ranges like 1-24 merged and searched with bisect"""
+    ranges = []
+    for value in values:
+        low, _, high = value.partition('-')
+        ranges.append((int(low), int(high or low)))
+    merged = []
+    for low, high in sorted(ranges):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    starts = [low for low, high in merged]
+    def matches(client):
+        value = str(client.get(field) or '')
+        if not value.isdigit():
+            return False
+        index = bisect.bisect_right(starts, int(value)) - 1
+        return index >= 0 and int(value) <= merged[index][1]
+    return matches
+
+CONDITION_COMPILERS = {
+    "description": compilePrefixes,
+    "mac": compileMacPrefixes,
+    "vlan": lambda values: compileRanges('vlan', values),
+    "port": lambda values: compileRanges('switchport', values),
+}
+
+def compileCondition(condition):
+    """turns one field=values condition into a function that takes a client"""
+    field, _, values = condition.partition('=')
+    field = field.strip()
+    if field not in CONDITION_COMPILERS or not values:
+        raise ValueError(f"Invalid filter {condition}, use {', '.join(CONDITION_COMPILERS)}=value,value")
+    return CONDITION_COMPILERS[field]([value.strip() for value in values.split(',') if value.strip()])
+
+def compileFilter(alternatives):
+    """compiles a profile's alternatives once into a single function that takes a client"""
+    compiled = [[compileCondition(condition) for condition in conditions] for conditions in alternatives]
+    if len(compiled) == 1 and len(compiled[0]) == 1:
+        return compiled[0][0]
+    def matches(client):
+        return any(all(condition(client) for condition in conditions) for conditions in compiled)
+    return matches
+
+# the filter every client goes through, main swaps it for the one asked for on the command line
+clientMatch = compileFilter(CLIENT_PROFILES["phones"])
+
+def portSortKey(client):
+    """sorts clients by port number with anything that isn't a number last"""
+    port = client.get('switchport') or ''
+    return (0, int(port), '') if port.isdigit() else (1, 0, port)
+#-------------------------------------------------------------------------------------
+
+async def getPhonesOnSwitch(aioDashboard, serial, switchName, report, timespan = CLIENT_TIMESPAN):
+    """writes the phones on one switch to the output file, errors are raised so the job queue can retry the switch"""
+    # stream the switch's clients through the phone filter, the shared rate limiter paces the call
+    phoneDevices = [client async for client in filterClients(streamClients(aioDashboard, serial=serial, timespan=timespan), clientMatch)]
+    return writeSwitchPhones(report, serial, switchName, phoneDevices)
+
+async def getPhonesOnNetwork(aioDashboard, networkId, switchesBySerial, phonesBySerial, timespan = CLIENT_TIMESPAN):
+    """streams a network's clients and files each phone under the switch it was last seen on,
+    clients last seen on anything that isn't one of our switches are dropped. returns the phones found"""
+    phones = filterClients(streamClients(aioDashboard, networkId=networkId, timespan=timespan),
+                           clientMatch, lambda client: client.get('recentDeviceSerial') in switchesBySerial)
+    # phones are only added once the whole network has been read so a retried network isn't counted twice
+    networkPhones = [client async for client in phones]
+    for client in networkPhones:
+        phonesBySerial.setdefault(client['recentDeviceSerial'], []).append(client)
+    found = len(networkPhones)
+    print(f"Processed clients on network {networkId}. Total phones found: {found}")
+    return found
+
+@traced
+def getPhonesInBulk(clients, report, timespan = CLIENT_TIMESPAN):
+    """one paged clients request per network instead of one request per switch, every org's networks are read at the same time.
+    the phones are joined back to their switches by serial and written in the same per switch report. returns the job results for the networks"""
+    return mergeOrgResults(runAcrossOrgs(clients, lambda aioDashboard: getOrgPhonesInBulk(aioDashboard, currentClient().switches, report, timespan)))
+
+async def getOrgPhonesInBulk(aioDashboard, switches, report, timespan = CLIENT_TIMESPAN):
+    """getPhonesInBulk for the switches of one org"""
+    switchesBySerial = {switch['serial']: switch for switch in switches}
+    networkIds = list(dict.fromkeys(switch['networkId'] for switch in switches))
+    phonesBySerial = {}
+    results = await runJobQueue(networkIds, lambda networkId: getPhonesOnNetwork(
+        aioDashboard, networkId, switchesBySerial, phonesBySerial, timespan))
+    failedNetworks = {result.item for result in results if not result.ok}
+    for switch in switches:
+        # a network that failed would look like it has no phones so its switches are left out of the report
+        if switch['networkId'] not in failedNetworks:
+            writeSwitchPhones(report, switch['serial'], switch['name'], phonesBySerial.get(switch['serial'], []))
+    return results
+
+def writeSwitchPhones(report, serial, switchName, phoneDevices):
+    """hands one switch's phones sorted by port to the report writer, returns how many there were"""
+    # Sort phone devices by switchport
+    # each client's key is worked out once up front then the clients are sorted on it
+    sortedPhoneDevices = [client for key, index, client in sorted((portSortKey(client), index, client) for index, client in enumerate(phoneDevices))]
+    report.write(serial, switchName, sortedPhoneDevices)
+    print(f"Processed phones on switch {switchName}. Total phones found: {len(sortedPhoneDevices)}")
+    return len(sortedPhoneDevices)
+
+#-------------------------------------------------------------------------------------
+# REPORT WRITERS
+REPORT_FIELDS = ["switch", "serial", "phone", "port", "mac", "ip", "vlan", "org"]
+PARQUET_ROW_GROUP = 10000       # phones buffered before a parquet row group is written
+
+def phoneRecord(serial, switchName, client, org = None):
+    """the report row for one phone"""
+    return {"switch": switchName, "serial": serial, "phone": client.get('description'), "port": client.get('switchport'),
+            "mac": client.get('mac'), "ip": client.get('ip'), "vlan": client.get('vlan'), "org": org}
+
+class TextReport:
+    """the original readable report, a block of phones under each switch"""
+    extension = ".txt"
+    def __init__(self, filename):
+        self.file = open(filename, "w")
+
+    def write(self, serial, switchName, phones, org = None):
+        self.file.write(f"Phones on switch {switchName}" + (f" in {org}" if org else "") + ":\n")
+        for client in phones:
+            self.file.write(f"Phone: {client.get('description')}, " # write it's name, mac, ip, port, and vlan
+                            f"Port: {client.get('switchport')}, "
+                            f"MAC: {client.get('mac', 'N/A')}, "
+                            f"IP: {client.get('ip', 'N/A')},"
+                            f" VLAN: {client.get('vlan', 'N/A')}\n")
+        self.file.write("\n")  # Add a newline for readability
+
+    def close(self):
+        self.file.close()
+
+class CsvReport:
+    """one row per phone with a header row"""
+    extension = ".csv"
+    def __init__(self, filename):
+        self.file = open(filename, "w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=REPORT_FIELDS)
+        self.writer.writeheader()
+
+    def write(self, serial, switchName, phones, org = None):
+        self.writer.writerows(phoneRecord(serial, switchName, client, org) for client in phones)
+
+    def close(self):
+        self.file.close()
+
+class JsonlReport:
+    """one JSON object per phone per line"""
+    extension = ".jsonl"
+    def __init__(self, filename):
+        self.file = open(filename, "w")
+
+    def write(self, serial, switchName, phones, org = None):
+        self.file.writelines(json.dumps(phoneRecord(serial, switchName, client, org)) + "\n" for client in phones)
+
+    def close(self):
+        self.file.close()
+
+class ParquetReport:
+    """phones buffered into row groups of a parquet file, needs pyarrow"""
+    extension = ".parquet"
+    def __init__(self, filename):
+        import pyarrow # type: ignore
+        import pyarrow.parquet # type: ignore
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(field, pyarrow.string()) for field in REPORT_FIELDS])
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        self.rows = []
+
+    def write(self, serial, switchName, phones, org = None):
+        self.rows += [{field: None if value is None else str(value) for field, value in phoneRecord(serial, switchName, client, org).items()}
+                      for client in phones]
+        if len(self.rows) >= PARQUET_ROW_GROUP:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(self.pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+REPORT_FORMATS = {"text": TextReport, "csv": CsvReport, "jsonl": JsonlReport, "parquet": ParquetReport}
+
+class ReportWriter:
+    """Background thread that owns the report file, every switch's phones are put on a queue and written
+    by this one thread so the file is opened once and workers never wait on each other to write.
+    an inventory passed in is shown every switch that was written. with labelOrgs each switch is labelled with the org
+    of the client that was current when it was queued so several orgs can share one report"""
+    def __init__(self, filename, reportFormat = "text", inventory = None, labelOrgs = False):
+        self.queue = queue.Queue()
+        self.report = REPORT_FORMATS[reportFormat](filename)
+        self.inventory = inventory
+        self.labelOrgs = labelOrgs
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
-def getPhonesOnSwitch(serial, switchName, output_filename):
+    def write(self, serial, switchName, phones):
+        """queue one switch's phones for the report"""
+        client = activeClient.get(None) if self.labelOrgs else None
+        self.queue.put((serial, switchName, phones, client.orgName if client else None))
+
+    def close(self):
+        """wait for everything queued to be written then close the file, raises anything that went wrong writing"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self.report.write(*item)
+                    if self.inventory:
+                        self.inventory.observe(*item[:3])
+                except Exception as e:
+                    self.error = e  # keep draining the queue so close doesn't hang
+        try:
+            self.report.close()
+        except Exception as e:
+            self.error = self.error or e
+#-------------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------------
+# PHONE INVENTORY
+PHONE_INVENTORY_FILE = "phone_inventory.db"     # kept in the output directory
+
+class PhoneInventory:
+    """Every phone seen so far keyed by MAC in a SQLite database that lasts between runs.
+    each run's phones are compared with what was stored to give the phones that were added, removed,
+    moved or changed VLAN, only switches that were actually read this run are compared so a switch
+    that failed doesn't look like all its phones were unplugged.
+    a phone that moved is still listed by its old switch until it drops out of the timespan, so every switch
+    listing a phone is kept as a sighting with when that switch started listing it and the phone is on the
+    switch that started listing it last, otherwise each poll of the old switch would move it back"""
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS phones (
+                               mac TEXT PRIMARY KEY,
+                               phone TEXT,
+                               serial TEXT,
+                               switch TEXT,
+                               port TEXT,
+                               vlan TEXT,
+                               ip TEXT,
+                               lastSeen TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS phonesBySerial ON phones (serial)")
+        # every switch currently listing each phone, firstSeen is when that switch started listing it
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sightings (
+                               mac TEXT,
+                               serial TEXT,
+                               phone TEXT,
+                               switch TEXT,
+                               port TEXT,
+                               vlan TEXT,
+                               ip TEXT,
+                               firstSeen REAL,
+                               PRIMARY KEY (mac, serial))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sightingsBySerial ON sightings (serial)")
+        # how many phones each switch had and when that last changed, for working out which switches are busy
+        self.db.execute("""CREATE TABLE IF NOT EXISTS switches (
+                               serial TEXT PRIMARY KEY,
+                               phoneCount INTEGER,
+                               checkedAt REAL,
+                               changedAt REAL)""")
+        self.seen = {}  # serial -> {mac: phone record} for the switches read this run
+
+    def observe(self, serial, switchName, phones):
+        """remember the phones read from one switch, called by the report writer thread"""
+        self.seen[serial] = {client['mac'].lower(): phoneRecord(serial, switchName, client) for client in phones if client.get('mac')}
+
+    def commit(self):
+        """compare this run with the stored inventory, store the new state and return the change events"""
+        now = time.time()
+        stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        columns = ("mac", "phone", "serial", "switch", "port", "vlan", "ip")
+        self.db.execute("BEGIN IMMEDIATE")
+        # update the sightings of the switches read, the phones they listed and the ones they stopped listing are the ones to check
+        touched = set()
+        for serial, records in self.seen.items():
+            listed = {mac for (mac,) in self.db.execute("SELECT mac FROM sightings WHERE serial = ?", (serial,))}
+            touched |= listed | records.keys()
+            touched.update(mac for (mac,) in self.db.execute("SELECT mac FROM phones WHERE serial = ?", (serial,)))
+            self.db.executemany("DELETE FROM sightings WHERE mac = ? AND serial = ?", [(mac, serial) for mac in listed - records.keys()])
+            self.db.executemany("""INSERT INTO sightings (mac, serial, phone, switch, port, vlan, ip, firstSeen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                   ON CONFLICT(mac, serial) DO UPDATE SET phone = excluded.phone, switch = excluded.switch,
+                                   port = excluded.port, vlan = excluded.vlan, ip = excluded.ip""",
+                                [(mac, serial, record["phone"], record["switch"], str(record["port"]), str(record["vlan"]),
+                                  record["ip"], now) for mac, record in records.items()])
+        events = []
+        current = {}
+        removed = []
+        for mac in touched:
+            row = self.db.execute("SELECT mac, phone, serial, switch, port, vlan, ip FROM phones WHERE mac = ?", (mac,)).fetchone()
+            previous = dict(zip(columns, row)) if row else None
+            sightings = self.db.execute("SELECT mac, phone, serial, switch, port, vlan, ip, firstSeen FROM sightings WHERE mac = ?", (mac,)).fetchall()
+            if not sightings:
+                if previous:
+                    removed.append(mac)
+                    events.append(phoneEvent("removed", mac, previous))
+                continue
+            # the switch that started listing the phone last, on a tie the phone stays where it was
+            newest = max(sightings, key=lambda sighting: (sighting[-1], previous is not None and sighting[2] == previous["serial"]))
+            record = current[mac] = dict(zip(columns, newest))
+            if previous is None:
+                events.append(phoneEvent("added", mac, record))
+            elif (previous["serial"], previous["port"]) != (record["serial"], record["port"]):
+                events.append(phoneEvent("moved", mac, record, previous))
+            elif previous["vlan"] != record["vlan"]:
+                events.append(phoneEvent("vlanChanged", mac, record, previous))
+        changedSerials = {event["serial"] for event in events} | {event.get("previousSerial") for event in events}
+        self.db.executemany("INSERT OR REPLACE INTO phones (mac, phone, serial, switch, port, vlan, ip, lastSeen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(mac, record["phone"], record["serial"], record["switch"], record["port"], record["vlan"],
+                              record["ip"], stamp) for mac, record in current.items()])
+        self.db.executemany("DELETE FROM phones WHERE mac = ?", [(mac,) for mac in removed])
+        for serial, records in self.seen.items():
+            self.db.execute("""INSERT INTO switches (serial, phoneCount, checkedAt, changedAt) VALUES (?, ?, ?, ?)
+                               ON CONFLICT(serial) DO UPDATE SET phoneCount = excluded.phoneCount, checkedAt = excluded.checkedAt,
+                               changedAt = CASE WHEN ? THEN excluded.changedAt ELSE switches.changedAt END""",
+                            (serial, len(records), now, now, serial in changedSerials))
+        self.db.execute("COMMIT")
+        self.seen = {}
+        return events
+
+    def lastChanged(self):
+        """serial -> when that switch's phones last changed"""
+        return dict(self.db.execute("SELECT serial, changedAt FROM switches"))
+
+def phoneEvent(event, mac, record, previous = None):
+    """one change to the phone inventory"""
+    change = {"event": event, "mac": mac, "phone": record["phone"], "switch": record["switch"], "serial": record["serial"],
+              "port": str(record["port"]), "vlan": str(record["vlan"])}
+    if previous:
+        change.update({"previousSwitch": previous["switch"], "previousSerial": previous["serial"],
+                       "previousPort": previous["port"], "previousVlan": previous["vlan"]})
+    return change
+
+def reportChanges(events, filename):
+    """print a summary of the changes since the last run and write them out one JSON object per line"""
+    if not events:
+        print("No phones changed since the last run")
+        return
+    counts = {}
+    for event in events:
+        counts[event["event"]] = counts.get(event["event"], 0) + 1
+    print("Changes since the last run: " + ", ".join(f"{count} {event}" for event, count in counts.items()))
+    with open(filename, "w") as file:
+        file.writelines(json.dumps(event) + "\n" for event in events)
+    print(f"Changes saved to {filename}")
+#-------------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------------
+# WATCH MODE
+WATCH_INTERVAL = 900            # seconds between polls of a quiet switch, stretched if the rate budget can't cover it
+WATCH_RATE_SHARE = 0.5          # share of the org's request rate watch mode uses so other scripts still get through
+WATCH_HOT_WINDOW = 3600         # a switch whose phones changed this recently is polled more often
+WATCH_HOT_FACTOR = 4            # how many times more often a recently changed switch is polled
+WATCH_TIMESPAN = 3600           # default client history in watch mode, short so moved and unplugged phones drop off their old switch soon
+WEBHOOK_TIMEOUT = 10            # seconds to wait on the webhook before giving up on an event
+
+class EventSink:
+    """sends change events to stdout and optionally a JSONL file and a webhook that takes a JSON list of events"""
+    def __init__(self, eventsFile = None, webhook = None):
+        self.eventsFile = eventsFile
+        self.webhook = webhook
+
+    async def emit(self, events):
+        for event in events:
+            where = f"{event['switch']} port {event['port']}"
+            if event.get("previousSerial"):
+                where = f"{event['previousSwitch']} port {event['previousPort']} -> {where}"
+            print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {event['event']}: {event['phone']} ({event['mac']}) on {where} VLAN {event['vlan']}")
+        if self.eventsFile:
+            with open(self.eventsFile, "a") as file:
+                file.writelines(json.dumps(event) + "\n" for event in events)
+        if self.webhook:
+            try:
+                await asyncio.to_thread(self.post, events)
+            except Exception as e:
+                print(f"Failed to send {len(events)} events to {self.webhook}: {e}")
+
+    def post(self, events):
+        import urllib.request   # only webhooks need it and it pulls in http and ssl, so it isn't imported at startup
+        request = urllib.request.Request(self.webhook, data=json.dumps(events).encode(), headers={"Content-Type": "application/json"})
+        urllib.request.urlopen(request, timeout=WEBHOOK_TIMEOUT).close()
+
+class PollScheduler:
+    """Decides when each switch is polled next. polls are spread evenly over the interval instead of all at once,
+    switches that changed in the last WATCH_HOT_WINDOW are polled WATCH_HOT_FACTOR times as often, and the
+    interval is stretched whenever that would take more than the watch mode's share of the org's rate limiter,
+    which is read on every poll so the polls slow down while meraki is answering with 429s"""
+    def __init__(self, switches, lastChanged, rateLimiter, interval = WATCH_INTERVAL):
+        self.switches = {switch['serial']: switch for switch in switches}
+        self.rateLimiter = rateLimiter
+        self.lastChanged = {serial: lastChanged.get(serial) or 0 for serial in self.switches}
+        self.baseInterval = interval
+        self.heap = []
+        now = time.time()
+        interval = self.interval()
+        # stagger the first polls across one interval, the busiest switches first
+        order = sorted(self.switches, key=lambda serial: -self.lastChanged[serial])
+        for position, serial in enumerate(order):
+            heapq.heappush(self.heap, (now + interval * position / len(order), serial))
+
+    def isHot(self, serial):
+        return time.time() - self.lastChanged[serial] < WATCH_HOT_WINDOW
+
+    def interval(self):
+        """seconds between polls of a quiet switch with the current number of hot switches"""
+        budget = self.rateLimiter.rate * WATCH_RATE_SHARE
+        hot = sum(1 for serial in self.switches if self.isHot(serial))
+        pollsPerInterval = len(self.switches) - hot + hot * WATCH_HOT_FACTOR
+        return max(self.baseInterval, pollsPerInterval / budget)
+
+    def __len__(self):
+        return len(self.heap)   # switches waiting for their next poll, the rest are being polled
+
+    def next(self):
+        """the next (due time, switch) to poll"""
+        due, serial = heapq.heappop(self.heap)
+        return due, self.switches[serial]
+
+    def done(self, serial, changed):
+        """schedule a switch's next poll after it's been polled"""
+        if changed:
+            self.lastChanged[serial] = time.time()
+        interval = self.interval()
+        if self.isHot(serial):
+            interval /= WATCH_HOT_FACTOR
+        heapq.heappush(self.heap, (time.time() + interval, serial))
+
+async def watchPhones(aioDashboard, switches, inventory, sink, interval = WATCH_INTERVAL, timespan = CLIENT_TIMESPAN):
+    """poll switches forever on the scheduler's timetable and send every change to the phone inventory to the sink"""
+    if not switches:
+        print("No switches to watch")
+        return
+    scheduler = PollScheduler(switches, inventory.lastChanged(), currentClient().rateLimiter, interval)
+    running = set()
+    limit = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def poll(switch):
+        changed = False
+        try:
+            async with limit:
+                phones = [client async for client in filterClients(streamClients(aioDashboard, serial=switch['serial'], timespan=timespan), clientMatch)]
+            inventory.observe(switch['serial'], switch['name'], phones)
+            events = inventory.commit()
+            changed = bool(events)
+            if events:
+                await sink.emit(events)
+        except Exception as e:
+            print(f"Failed to poll switch {switch['name']}: {e}")
+        scheduler.done(switch['serial'], changed)
+
+    print(f"Watching {len(switches)} switches, each polled about every {int(scheduler.interval())} seconds. Press Ctrl-C to stop")
+    while True:
+        if not scheduler:
+            # every switch is being polled, wait for one to finish and be rescheduled
+            await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            continue
+        due, switch = scheduler.next()
+        await asyncio.sleep(max(0, due - time.time()))
+        task = asyncio.create_task(poll(switch))
+        running.add(task)
+        task.add_done_callback(running.discard)
+#-------------------------------------------------------------------------------------
+
+def parseArguments():
+    """command line options"""
+    parser = argparse.ArgumentParser(description="Find every phone connected to a Meraki switch in the organization")
+    parser.add_argument("--org", metavar="ORGS", help="organizations to report on, names or IDs separated by commas or all. "
+                        "every org is read at the same time into one report, defaults to the first organization the key can see")
+    parser.add_argument("--bulk", action="store_true",
+                        help="read clients a network at a time instead of a switch at a time, far fewer API calls on large orgs")
+    parser.add_argument("--format", choices=REPORT_FORMATS, default="text",
+                        help="report format, text is the readable report and csv, jsonl and parquet are for other tools")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running, polling switches in turn and reporting phones that appear, vanish or move, "
+                             "a shorter --timespan makes unplugged phones show as vanished sooner")
+    parser.add_argument("--interval", type=int, default=WATCH_INTERVAL, metavar="SECONDS",
+                        help=f"in watch mode, seconds between polls of a switch whose phones haven't changed recently (default {WATCH_INTERVAL})")
+    parser.add_argument("--events-file", metavar="FILE", help="in watch mode, also append change events to this JSONL file")
+    parser.add_argument("--webhook", metavar="URL", help="in watch mode, also POST change events to this URL as JSON")
+    parser.add_argument("--profile", choices=CLIENT_PROFILES, default="phones",
+                        help="which clients to report, phones are the SEP named phones the report has always listed")
+    parser.add_argument("--match", action="append", metavar="FIELD=VALUES",
+                        help="report clients matching every --match instead of a profile, fields are "
+                             "description (name prefixes), mac (MAC or OUI prefixes), vlan and port (numbers or ranges like 1-24)")
+    parser.add_argument("--metrics", metavar="FILE", help="save per endpoint API call metrics and operation spans when the script ends, "
+                        "as prometheus text for a .prom file or JSON otherwise")
+    parser.add_argument("--timespan", type=int, metavar="SECONDS",
+                        help=f"how far back to look for clients, up to {MAX_CLIENT_TIMESPAN} seconds "
+                             f"(default {CLIENT_TIMESPAN}, or {WATCH_TIMESPAN} or the --interval if longer in watch mode)")
+    args = parser.parse_args()
+    if args.timespan is None:
+        args.timespan = max(WATCH_TIMESPAN, args.interval) if args.watch else CLIENT_TIMESPAN
+    if not 0 < args.timespan <= MAX_CLIENT_TIMESPAN:
+        parser.error(f"--timespan must be between 1 and {MAX_CLIENT_TIMESPAN} seconds")
     try:
-        # Use the semaphore to control API call rate
-        with api_semaphore:
-            # Slight delay to help distribute API calls
-            time.sleep(0.1)
-            # Retrieve all devices from the switch
-            response = dashboard.devices.getDeviceClients(serial)
-            # Filter only phone devices (names starting with SEP)
-            phoneDevices = [client for client in response if client.get('description') and client['description'].startswith('SEP')]
-            # Sort phone devices by switchport
-            sortedPhoneDevices = sorted(phoneDevices, key=lambda client: int(client.get('switchport')) if client.get('switchport') and client.get('switchport').isdigit() else float('inf'))
-            # Thread-safe file writing
-            with file_lock:
-                with open(output_filename, "a") as file:
-                    file.write(f"Phones on switch {switchName}:\n")
-                    for client in sortedPhoneDevices:
-                        file.write(f"Phone: {client.get('description')}, " # write it's name, mac, ip, port, and vlan
-                                   f"Port: {client.get('switchport')}, "
-                                   f"MAC: {client.get('mac', 'N/A')}, "
-                                   f"IP: {client.get('ip', 'N/A')},"
-                                   f" VLAN: {client.get('vlan', 'N/A')}\n")
-                    file.write("\n")  # Add a newline for readability
-            
-            print(f"Processed phones on switch {switchName}. Total phones found: {len(sortedPhoneDevices)}")
-    
-    except meraki.APIError as e:
-        print(f"Meraki API Error on switch {switchName}: {e}")
-    except Exception as e:
-        print(f"Error processing switch {switchName}: {e}")
+        args.clientMatch = compileFilter([args.match] if args.match else CLIENT_PROFILES[args.profile])
+    except ValueError as e:
+        parser.error(str(e))
+    if args.format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        parser.error("--format parquet needs the pyarrow package, install it or pick another format")
+    return args
 
 def main():
+    global clientMatch
+    args = parseArguments()
+    clientMatch = args.clientMatch
+    if args.metrics:
+        atexit.register(callMetrics.save, os.path.abspath(args.metrics))
     KEY_FILE = "vlanScriptKey.txt"
     url = "https://documentation.meraki.com/General_Administration/Other_Topics/Cisco_Meraki_Dashboard_API"
     while True:
@@ -92,60 +650,89 @@ def main():
                 continue
             else:
                 with open(KEY_FILE, "r") as file:
-                    API_KEY = file.read().strip()
+                    apiKey = file.read().strip()
                     break
         else:
             with open(KEY_FILE, "r") as file:
-                API_KEY = file.read().strip()
+                apiKey = file.read().strip()
                 break
             
-        if not API_KEY: # if there is no valid API key 
+        if not apiKey: # if there is no valid API key 
             print("No valid API Key, check vlanScriptKey.txt(should contain ONLY the API key)")
             os.remove(KEY_FILE)
             continue
         else:
             break
     
-    global dashboard 
-    global orgID
     try:
-        dashboard = meraki.DashboardAPI(API_KEY, output_log=False,print_console=False,suppress_logging=True)  # open dashboard
+        client = MerakiClient(apiKey)  # open dashboard
     except Exception as e:
         print ("Failed to connect with dashboard, ending script...")
         return # display an error and end the script
     try:
-        orgID = getOrgID()  # get the orgID
+        allOrgs = client.getOrganizations()  # get organizations list
+        orgs = selectOrganizations(allOrgs, args.org)
+    except ValueError as e:
+        print(e)
+        return
     except Exception as e:
         print("Unable to get org ID, ending script...")
         return
-    switches = getSwitches(orgID) # get all switches and store them in a list   
+    if not orgs:
+        print("Unable to get org ID, ending script...")
+        return
+    if not args.org and len(allOrgs) > 1:
+        print(f"Using organization {orgs[0].get('name')}, the key can see {len(allOrgs)}. Pick others with --org")
+    # the first org reuses the dashboard already open, every other org gets a client and rate limit of its own
+    client.orgID, client.orgName = orgs[0]['id'], orgs[0].get('name')
+    clients = [client] + [client.forOrganization(org) for org in orgs[1:]]
+    activeClient.set(client)
+    # get every org's switches at the same time and store them in a list on its client
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(clients)) as executor:
+            for orgClient, switches in zip(clients, executor.map(lambda orgClient: getSwitches(orgClient, switchCacheFile(orgClient)), clients)):
+                orgClient.switches = switches
+    except Exception as e:
+        print(f"Unable to get switches, ending script... {e}")
+        return
+    switches = [switch for orgClient in clients for switch in orgClient.switches]
     run_timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     # Get output directory
     output_dir = getOutputDir()
+    if args.watch:
+        inventory = PhoneInventory(os.path.join(output_dir, PHONE_INVENTORY_FILE))
+        sink = EventSink(args.events_file, args.webhook)
+        try:
+            # every org is watched on its own schedule within its own rate limit
+            mergeOrgResults(runAcrossOrgs(clients, lambda aioDashboard: watchPhones(
+                aioDashboard, currentClient().switches, inventory, sink, args.interval, args.timespan)))
+        except KeyboardInterrupt:
+            print("Watch stopped")
+        return
     # Create output filename
-    output_filename = os.path.join(output_dir, f"meraki_phones_{run_timestamp}.txt")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        # Create a list to hold our futures
-        futures = []
-        
-        # Submit jobs for each switch
+    output_filename = os.path.join(output_dir, f"meraki_phones_{run_timestamp}{REPORT_FORMATS[args.format].extension}")
+    inventory = PhoneInventory(os.path.join(output_dir, PHONE_INVENTORY_FILE))
+    # a report for one org reads the same as it always has, the org is only named when there are several
+    report = ReportWriter(output_filename, args.format, inventory, labelOrgs=len(clients) > 1)
+    if args.bulk:
+        results = getPhonesInBulk(clients, report, args.timespan)
+        reportJobs(results, "Networks processed", lambda networkId: f"network {networkId}")
+    else:
         for switch in switches:
-            serial = switch['serial']
-            switchName = switch['name']
-            print(f"Queuing phones retrieval for switch {switchName}...")
-            # Submit the task to the thread pool
-            future = executor.submit(
-                getPhonesOnSwitch, 
-                serial, 
-                switchName,  
-                output_filename
-            )
-            futures.append(future)
-        
-        # Wait for all futures to complete
-        concurrent.futures.wait(futures)
-    
+            print(f"Queuing phones retrieval for switch {switch['name']}...")
+        # every switch is a job on one shared queue, workers pull the next switch as soon as they finish one
+        # and every org has its own queue, all of them running at once
+        with callMetrics.span("getPhonesPerSwitch", switches=len(switches), orgs=len(clients)):
+            results = mergeOrgResults(runAcrossOrgs(clients, lambda aioDashboard: runJobQueue(currentClient().switches, lambda switch: getPhonesOnSwitch(
+                aioDashboard,
+                switch['serial'],
+                switch['name'],
+                report,
+                args.timespan))))
+        reportJobs(results, "Switches processed", lambda switch: f"switch {switch['name']}")
+    report.close()
     print(f"All switches processed. Output saved to {output_filename}")
+    reportChanges(inventory.commit(), os.path.join(output_dir, f"meraki_phone_changes_{run_timestamp}.jsonl"))
       
 if __name__ == "__main__":
     main()
\ No newline at end of file
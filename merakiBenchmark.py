@@ -0,0 +1,462 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+#-------------------------------------------------------------------------------------
+# SIMULATED DASHBOARD
+# a stand in for meraki.DashboardAPI and meraki.AsyncDashboardAPI that serves a made up org from memory,
+# it answers the calls the scripts make with the same shapes meraki does, charges every page of a paginated
+# call against the org's rate limit and answers with 429s and a Retry-After once that limit is used up
+SIM_ORG_ID = "100000"
+SWITCHES_PER_NETWORK = 50       # switches in each simulated network
+PHONE_SHARE = 0.6               # share of simulated clients that are SEP phones
+ACTION_SECONDS = 0.002          # simulated time an action batch spends on each action
+
+class SimulatedAPIError(Exception):
+    """looks like meraki.APIError to the scripts, a status plus a response with headers"""
+    def __init__(self, status, message, headers = None):
+        super().__init__(f"{status} {message}")
+        self.status = status
+        self.message = message
+        self.response = type("Response", (), {"status_code": status, "headers": headers or {}})()
+
+class SimulatedOrg:
+    """the synthetic org's switches, ports, clients and action batches"""
+    def __init__(self, switchCount = 200, portsPerSwitch = 48, clientsPerSwitch = 30, seed = 1):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.switches = []
+        self.ports = {}
+        self.clients = {}
+        self.batches = {}
+        for index in range(switchCount):
+            serial = f"Q2SW-{index // 10000:04d}-{index % 10000:04d}"
+            switch = {"serial": serial, "name": f"SIM{index:05d}-SW", "productType": "switch", "model": "MS120-48",
+                      "networkId": f"N_{index // SWITCHES_PER_NETWORK}"}
+            self.switches.append(switch)
+            self.ports[serial] = {str(port): {"portId": str(port), "name": None, "vlan": 10, "voiceVlan": 20 if port % 2 else None,
+                                              "type": "access", "enabled": True} for port in range(1, portsPerSwitch + 1)}
+            clients = []
+            for number in range(clientsPerSwitch):
+                mac = f"00:1a:{index // 256 % 256:02x}:{index % 256:02x}:{number // 256:02x}:{number % 256:02x}"
+                isPhone = rng.random() < PHONE_SHARE
+                clients.append({"id": f"k{index:05d}{number:04d}", "mac": mac, "ip": f"10.{index // 256 % 256}.{index % 256}.{number + 1}",
+                                "description": f"SEP{mac.replace(':', '').upper()}" if isPhone else f"PC-{index}-{number}",
+                                "vlan": 20 if isPhone else 10, "switchport": str(number % portsPerSwitch + 1),
+                                "recentDeviceSerial": serial, "recentDeviceName": switch["name"], "recentDeviceConnection": "Wired"})
+            self.clients[serial] = clients
+
+    # ORGANIZATIONS
+    def getOrganizations(self):
+        return [{"id": SIM_ORG_ID, "name": "Simulated Org"}]
+
+    def getOrganizationDevices(self, organizationId, productTypes = None, **kwargs):
+        return [dict(switch) for switch in self.switches if not productTypes or switch["productType"] in productTypes]
+
+    def getOrganizationConfigurationChanges(self, organizationId, **kwargs):
+        return []
+
+    def createOrganizationActionBatch(self, organizationId, actions, confirmed = False, synchronous = False, **kwargs):
+        if len(actions) > 100:
+            raise SimulatedAPIError(400, "Action batches are limited to 100 actions")
+        with self.lock:
+            now = time.time()
+            running = [batch for batch in self.batches.values() if batch["finishAt"] > now]
+            if len(running) >= 5:
+                raise SimulatedAPIError(400, "Too many concurrently executing batches")
+            errors = []
+            for action in actions:
+                parts = action["resource"].strip("/").split("/")
+                port = self.ports.get(parts[1], {}).get(parts[4])
+                if port is None:
+                    errors.append(f"{action['resource']} not found")
+            if not errors:
+                for action in actions:
+                    parts = action["resource"].strip("/").split("/")
+                    self.ports[parts[1]][parts[4]].update(action["body"])
+            batchId = str(len(self.batches) + 1)
+            self.batches[batchId] = {"id": batchId, "finishAt": now + len(actions) * ACTION_SECONDS, "errors": errors}
+            return self.getOrganizationActionBatch(organizationId, batchId)
+
+    def getOrganizationActionBatch(self, organizationId, actionBatchId):
+        batch = self.batches[actionBatchId]
+        finished = time.time() >= batch["finishAt"]
+        return {"id": batch["id"], "confirmed": True,
+                "status": {"completed": finished and not batch["errors"], "failed": finished and bool(batch["errors"]),
+                           "errors": batch["errors"] if finished else []}}
+
+    # SWITCH
+    def getOrganizationSwitchPortsBySwitch(self, organizationId, serials = None, **kwargs):
+        wanted = set(serials) if serials else None
+        return [{"serial": switch["serial"], "name": switch["name"], "model": switch["model"], "networkId": switch["networkId"],
+                 "ports": [dict(port) for port in self.ports[switch["serial"]].values()]}
+                for switch in self.switches if wanted is None or switch["serial"] in wanted]
+
+    def getDeviceSwitchPorts(self, serial):
+        return [dict(port) for port in self.ports[serial].values()]
+
+    def getDeviceSwitchPort(self, serial, portId):
+        port = self.ports.get(serial, {}).get(str(portId))
+        if port is None:
+            raise SimulatedAPIError(404, "Not found")
+        return dict(port)
+
+    def updateDeviceSwitchPort(self, serial, portId, **kwargs):
+        with self.lock:
+            port = self.ports.get(serial, {}).get(str(portId))
+            if port is None:
+                raise SimulatedAPIError(404, "Not found")
+            port.update({key: value for key, value in kwargs.items() if key in ("vlan", "voiceVlan", "name", "type", "enabled")})
+            return dict(port)
+
+    # DEVICES
+    def getDeviceClients(self, serial, **kwargs):
+        return [dict(client) for client in self.clients.get(serial, [])]
+
+    # NETWORKS
+    def getNetworkClients(self, networkId, **kwargs):
+        return [dict(client) for switch in self.switches if switch["networkId"] == networkId for client in self.clients[switch["serial"]]]
+
+# paginated endpoints and the page size meraki uses when a call doesn't give one
+PAGINATED = {"getOrganizationDevices": 1000, "getOrganizationSwitchPortsBySwitch": 50, "getOrganizationConfigurationChanges": 5000,
+             "getNetworkClients": 10}
+
+class CallStats:
+    """counts and latencies of the calls the simulator answered"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.rateLimited = 0
+            self.latencies = []
+
+    def record(self, endpoint, latency):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.latencies.append(latency)
+
+    def total(self):
+        return sum(self.calls.values())
+
+    def percentile(self, share):
+        if not self.latencies:
+            return 0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+class SimulatedDashboard:
+    """the simulated org behind a rate limit and network latency, sync or async like the meraki SDK.
+    the async one hands paginated calls back as iterators like an SDK dashboard opened with use_iterator_for_get_pages"""
+    def __init__(self, org, ratePerSecond = 10, latency = 0.05, jitter = 0.5, tailRate = 0.01, asyncMode = False, stats = None, seed = 1):
+        self.org = org
+        self.ratePerSecond = ratePerSecond
+        self.latency = latency
+        self.jitter = jitter
+        self.tailRate = tailRate
+        self.asyncMode = asyncMode
+        self.stats = stats or CallStats()
+        self.rng = random.Random(seed)
+        self.tokens = ratePerSecond
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        for section in ("organizations", "switch", "devices", "networks"):
+            setattr(self, section, SimulatedSection(self))
+
+    def asyncDashboard(self):
+        """an async dashboard sharing this one's org, rate limit and stats"""
+        twin = SimulatedDashboard(self.org, self.ratePerSecond, self.latency, self.jitter, self.tailRate, True, self.stats)
+        twin.bucket = self  # both spend the same org's requests
+        return twin
+
+    def takeToken(self):
+        """take a request from the org's budget, raises a 429 when there isn't one"""
+        bucket = getattr(self, "bucket", self)
+        with bucket.lock:
+            now = time.monotonic()
+            bucket.tokens = min(self.ratePerSecond, bucket.tokens + (now - bucket.updated) * self.ratePerSecond)
+            bucket.updated = now
+            if bucket.tokens < 1:
+                self.stats.rateLimited += 1
+                raise SimulatedAPIError(429, "Too Many Requests", {"Retry-After": str(math.ceil((1 - bucket.tokens) / self.ratePerSecond))})
+            bucket.tokens -= 1
+
+    def delay(self):
+        delay = self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+        return delay * 10 if self.rng.random() < self.tailRate else delay
+
+    def pages(self, name, result, kwargs):
+        """how many requests a call costs, a paginated call asking for every page pays for each one"""
+        if name not in PAGINATED or kwargs.get("total_pages") not in ("all", -1):
+            return 1
+        return max(1, math.ceil(len(result) / kwargs.get("perPage", PAGINATED[name])))
+
+    def call(self, name, args, kwargs):
+        result = getattr(self.org, name)(*args, **kwargs)
+        for page in range(self.pages(name, result, kwargs)):
+            self.takeToken()
+            started = time.perf_counter()
+            time.sleep(self.delay())
+            self.stats.record(name, time.perf_counter() - started)
+        return result
+
+    async def callAsync(self, name, args, kwargs):
+        result = getattr(self.org, name)(*args, **kwargs)
+        for page in range(self.pages(name, result, kwargs)):
+            self.takeToken()
+            started = time.perf_counter()
+            await asyncio.sleep(self.delay())
+            self.stats.record(name, time.perf_counter() - started)
+        return result
+
+    async def iterateAsync(self, name, args, kwargs):
+        """a paginated call's items a page at a time, each page paying for its own request"""
+        result = getattr(self.org, name)(*args, **kwargs)
+        perPage = kwargs.get("perPage", PAGINATED[name])
+        lastPage = 1 if kwargs.get("total_pages") not in ("all", -1) else max(1, math.ceil(len(result) / perPage))
+        for page in range(lastPage):
+            self.takeToken()
+            started = time.perf_counter()
+            await asyncio.sleep(self.delay())
+            self.stats.record(name, time.perf_counter() - started)
+            for item in result[page * perPage:(page + 1) * perPage]:
+                yield item
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+class SimulatedSection:
+    """any endpoint on the simulated org looked up by name, like a section of the SDK"""
+    def __init__(self, dashboard):
+        self.dashboard = dashboard
+
+    def __getattr__(self, name):
+        if not hasattr(self.dashboard.org, name):
+            raise AttributeError(name)
+        if self.dashboard.asyncMode:
+            def endpointAsync(*args, **kwargs):
+                if name in PAGINATED:
+                    return self.dashboard.iterateAsync(name, args, kwargs)
+                return self.dashboard.callAsync(name, args, kwargs)
+            endpointAsync.__name__ = name   # the scripts' metrics are kept by endpoint name
+            return endpointAsync
+        def endpoint(*args, **kwargs):
+            return self.dashboard.call(name, args, kwargs)
+        endpoint.__name__ = name
+        return endpoint
+#-------------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------------
+# BENCHMARKS
+class Benchmark:
+    """one timed operation and what it cost"""
+    def __init__(self, name, units, unitName, wall, stats):
+        self.name = name
+        self.units = units
+        self.unitName = unitName
+        self.wall = wall
+        self.calls = stats.total()
+        self.rateLimited = stats.rateLimited
+        self.p50 = stats.percentile(0.5)
+        self.p99 = stats.percentile(0.99)
+
+    def row(self):
+        return {"operation": self.name, "units": self.units, "unit": self.unitName, "wallSeconds": round(self.wall, 3),
+                "throughput": round(self.units / self.wall, 2) if self.wall else 0, "apiCalls": self.calls,
+                "callsPerUnit": round(self.calls / self.units, 3) if self.units else 0, "rateLimited": self.rateLimited,
+                "p50Ms": round(self.p50 * 1000, 1), "p99Ms": round(self.p99 * 1000, 1)}
+
+def timeOperation(name, unitName, stats, operation, verbose = False):
+    """run operation with the simulator's stats reset, it returns how many units of work it did"""
+    stats.reset()
+    started = time.perf_counter()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        units = operation()
+    return Benchmark(name, units, unitName, time.perf_counter() - started, stats)
+
+def useSimulator(module, dashboard):
+    """point one of the scripts at the simulator by making a client for it current,
+    every call still goes through the script's own rate limiter"""
+    client = module.MerakiClient("simulated", SIM_ORG_ID, api=dashboard, asyncApi=dashboard.asyncDashboard,
+                                 ratePerSecond=dashboard.ratePerSecond)
+    module.activeClient.set(client)
+    return client
+
+def benchmarkVlanManager(dashboard, verbose = False):
+    """time the VLAN manager's bulk operations against the simulator"""
+    import Meraki_VLAN_Manager as vlanManager
+    client = useSimulator(vlanManager, dashboard)
+    stats = dashboard.stats
+    switches = vlanManager.getSwitches(client, refresh=True)
+    names = {switch["serial"]: switch["name"] for switch in switches}
+    first = switches[0]
+    ports = list(dashboard.org.ports[first["serial"]])
+    results = []
+
+    def bulkOneSwitch():
+        vlanManager.bulkChangePortVlan(first["serial"], first["name"], ports, "200", "")
+        return len(ports)
+    results.append(timeOperation("bulkChangePortVlan (one switch)", "ports", stats, bulkOneSwitch, verbose))
+
+    # changePortAllSwitches asks for its port and VLANs, this is the update it pushes once they're entered
+    def portAllSwitches():
+        updates = [(switch["serial"], "1", "300", "") for switch in switches]
+        return len(updates) - len(vlanManager.applyPortUpdates(updates, "bulk", names))
+    results.append(timeOperation("changePortAllSwitches", "ports", stats, portAllSwitches, verbose))
+    db = vlanManager.getRollbackDb()
+    allSwitchesChangeSet = db.execute("SELECT MAX(id) FROM changesets").fetchone()[0]
+
+    def perPort():
+        return len(ports) - len(vlanManager.perPortChangePortVlan(first["serial"], first["name"], ports, "210", ""))
+    lastId = db.execute("SELECT COALESCE(MAX(id), 0) FROM rollback").fetchone()[0]
+    results.append(timeOperation("perPortChangePortVlan (one switch)", "ports", stats, perPort, verbose))
+
+    vlanManager.journalWriter.flush()
+    rollbackIds = [row[0] for row in db.execute("SELECT id FROM rollback WHERE id > ? AND deleted = 0", (lastId,))]
+    def bulkRollback():
+        vlanManager.bulkRollbackPortVlan(rollbackIds)
+        return len(rollbackIds)
+    results.append(timeOperation("bulkRollbackPortVlan", "ports", stats, bulkRollback, verbose))
+
+    def changeSetRollback():
+        vlanManager.rollbackChangeSet(allSwitchesChangeSet)
+        return len(switches)
+    results.append(timeOperation("rollbackChangeSet (all switches)", "ports", stats, changeSetRollback, verbose))
+    vlanManager.journalWriter.flush()
+    return results
+
+def benchmarkGetPhones(dashboard, verbose = False):
+    """time getPhones' per switch and bulk modes against the simulator"""
+    import getPhones
+    from merakiCommon import runAsync
+    client = useSimulator(getPhones, dashboard)
+    getPhones.getOutputDir = os.getcwd
+    stats = dashboard.stats
+    switches = client.switches = getPhones.getSwitches(client, getPhones.switchCacheFile(client))
+    results = []
+
+    def perSwitch():
+        report = getPhones.ReportWriter("phones_per_switch.txt")
+        runAsync(lambda aioDashboard: getPhones.runJobQueue(switches, lambda switch: getPhones.getPhonesOnSwitch(
+            aioDashboard, switch["serial"], switch["name"], report)))
+        report.close()
+        return len(switches)
+    results.append(timeOperation("getPhones (per switch)", "switches", stats, perSwitch, verbose))
+
+    def bulk():
+        report = getPhones.ReportWriter("phones_bulk.txt")
+        getPhones.getPhonesInBulk([client], report)
+        report.close()
+        return len(switches)
+    results.append(timeOperation("getPhones --bulk", "switches", stats, bulk, verbose))
+    return results
+
+def printResults(results):
+    printTable([result.row() for result in results],
+               ("operation", "units", "wallSeconds", "throughput", "apiCalls", "callsPerUnit", "rateLimited", "p50Ms", "p99Ms"))
+
+def printTable(rows, columns):
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in columns}
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(str(row[column]).ljust(widths[column]) for column in columns))
+#-------------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------------
+# STARTUP
+# each command runs in a fresh interpreter so nothing it imports is already loaded,
+# the package scan and SDK import are what the scripts used to do before reaching main
+STARTUP_RUNS = 5
+PACKAGE_SCAN = "import importlib.metadata; {pkg.metadata['Name'] for pkg in importlib.metadata.distributions()}"
+
+def timeCommand(command, runs):
+    """median and slowest wall time of running command in milliseconds, None if it fails"""
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+            return None
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times), max(times)
+
+def benchmarkStartup(runs = STARTUP_RUNS):
+    """time how long each script takes to answer --help against a bare interpreter and the imports it no longer does up front"""
+    folder = os.path.dirname(os.path.abspath(__file__))
+    commands = [("python", [sys.executable, "-c", "pass"]),
+                ("Meraki_VLAN_Manager.py --help", [sys.executable, os.path.join(folder, "Meraki_VLAN_Manager.py"), "--help"]),
+                ("getPhones.py --help", [sys.executable, os.path.join(folder, "getPhones.py"), "--help"]),
+                ("installed package scan", [sys.executable, "-c", PACKAGE_SCAN]),
+                ("import meraki", [sys.executable, "-c", "import meraki, meraki.aio"])]
+    rows = []
+    for name, command in commands:
+        timing = timeCommand(command, runs)
+        if timing is None:
+            # import meraki fails where the SDK isn't installed
+            rows.append({"command": name, "runs": runs, "medianMs": "failed", "maxMs": "", "overPythonMs": ""})
+            continue
+        median, slowest = timing
+        rows.append({"command": name, "runs": runs, "medianMs": round(median, 1), "maxMs": round(slowest, 1),
+                     "overPythonMs": round(median - rows[0]["medianMs"], 1) if rows else 0})
+    return rows
+#-------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VLAN manager and getPhones against a simulated Meraki org, no API key or network needed")
+    parser.add_argument("--switches", type=int, default=200, help="switches in the simulated org (default 200)")
+    parser.add_argument("--ports", type=int, default=48, help="ports on each switch (default 48)")
+    parser.add_argument("--clients", type=int, default=30, help="clients on each switch (default 30)")
+    parser.add_argument("--rate", type=float, default=10, help="requests a second the simulated org allows before answering 429 (default 10, meraki's limit)")
+    parser.add_argument("--latency", type=float, default=50, help="average milliseconds each simulated call takes (default 50)")
+    parser.add_argument("--jitter", type=float, default=0.5, help="how far latency varies either side of the average, as a share of it (default 0.5)")
+    parser.add_argument("--tail", type=float, default=0.01, help="share of calls that take ten times as long (default 0.01)")
+    parser.add_argument("--only", choices=("vlan", "phones", "startup"), help="only benchmark one of the scripts, or only time how long they take to start")
+    parser.add_argument("--runs", type=int, default=STARTUP_RUNS, help=f"times each startup command is run (default {STARTUP_RUNS})")
+    parser.add_argument("--json", metavar="FILE", help="also save the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the scripts' own output while they run")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    jsonFile = os.path.abspath(args.json) if args.json else None
+    if args.only == "startup":
+        rows = benchmarkStartup(args.runs)
+        printTable(rows, ("command", "runs", "medianMs", "maxMs", "overPythonMs"))
+        if jsonFile:
+            with open(jsonFile, "w") as file:
+                json.dump(rows, file, indent=2)
+        return
+    org = SimulatedOrg(args.switches, args.ports, args.clients)
+    dashboard = SimulatedDashboard(org, args.rate, args.latency / 1000, args.jitter, args.tail)
+    # the scripts write their journals, logs and caches to the working directory so run somewhere disposable
+    workDir = tempfile.mkdtemp(prefix="merakiBenchmark")
+    os.chdir(workDir)
+    print(f"Simulated org: {args.switches} switches, {args.ports} ports and {args.clients} clients each, "
+          f"{args.rate} requests a second, {args.latency}ms latency. Working in {workDir}")
+    results = []
+    if args.only != "phones":
+        results += benchmarkVlanManager(dashboard, args.verbose)
+    if args.only != "vlan":
+        results += benchmarkGetPhones(dashboard, args.verbose)
+    printResults(results)
+    if jsonFile:
+        with open(jsonFile, "w") as file:
+            json.dump([result.row() for result in results], file, indent=2)
+
+if __name__ == "__main__":
+    main()
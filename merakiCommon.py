@@ -0,0 +1,502 @@
+# shared by Meraki_VLAN_Manager.py and getPhones.py: loading the meraki SDK, the per-org rate limiter and the
+# dashboard wrapper that goes through it, API call metrics, the async job queue, the per-org client and which org
+# is being worked on, and the cached switch list. keep it next to the scripts, they import it from their own folder
+from datetime import datetime, timezone
+import importlib.util
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# the meraki SDK takes longer to import than the rest of the script put together so it's only imported,
+# and installed with pip if it's missing, when the first dashboard is opened. --help never pays for it.
+# call loadMeraki() instead of importing meraki from here, this global is only set once it has run
+meraki = None
+
+def loadMeraki():
+    """import the meraki SDK the first time it's needed, find_spec only looks for the package
+    instead of reading the metadata of every installed distribution"""
+    global meraki
+    if meraki is None:
+        if importlib.util.find_spec("meraki") is None:
+            subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'meraki'])
+            importlib.invalidate_caches()
+        import meraki # type: ignore
+        import meraki.aio # type: ignore
+    return meraki
+
+#-------------------------------------------------------------------------------------
+# RATE LIMITING
+ORG_REQUESTS_PER_SECOND = 10    # meraki allows each organization 10 API requests a second
+MIN_REQUESTS_PER_SECOND = 1     # the limiter never slows down past this while backing off
+MAX_RATE_LIMIT_RETRIES = 5      # how many times a call is retried after a 429 before giving up
+
+class RateLimiter:
+    """Token bucket shared by every thread in the script so all dashboard calls for an org stay under its rate limit.
+    A 429 pauses every caller for the Retry-After time and halves the rate, which then creeps back up as calls succeed"""
+    def __init__(self, ratePerSecond = ORG_REQUESTS_PER_SECOND):
+        self.maxRate = ratePerSecond
+        self.rate = ratePerSecond
+        self.tokens = ratePerSecond
+        self.updated = time.monotonic()
+        self.pausedUntil = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """take a token from the bucket, returns how many seconds the caller has to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.pausedUntil - now)
+
+    def acquire(self):
+        """block until the caller is allowed to make a request"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def onSuccess(self):
+        """slowly give back capacity taken away by earlier 429s"""
+        if self.rate < self.maxRate:
+            with self.lock:
+                self.rate = min(self.maxRate, self.rate + 0.1)
+
+    def onRateLimited(self, retryAfter):
+        """pause every caller until meraki's Retry-After has passed and cut the rate in half"""
+        with self.lock:
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + retryAfter)
+            self.rate = max(MIN_REQUESTS_PER_SECOND, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def call(self, func, *args, **kwargs):
+        """make a dashboard call once the limiter allows it, retrying when meraki answers with a 429"""
+        started = time.perf_counter()
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if getattr(e, "status", None) != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+                    callMetrics.record(func, started, attempt, e, limiter=self)
+                    raise
+                self.onRateLimited(getRetryAfter(e))
+                continue
+            self.onSuccess()
+            callMetrics.record(func, started, attempt, limiter=self)
+            return result
+
+    async def callAsync(self, func, *args, **kwargs):
+        """same as call but for the async dashboard, waiting on the event loop instead of blocking the thread"""
+        started = time.perf_counter()
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            wait = self.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if getattr(e, "status", None) != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+                    callMetrics.record(func, started, attempt, e, limiter=self)
+                    raise
+                self.onRateLimited(getRetryAfter(e))
+                continue
+            self.onSuccess()
+            callMetrics.record(func, started, attempt, limiter=self)
+            return result
+
+    async def iterateAsync(self, func, *args, **kwargs):
+        """same as callAsync for a paginated call that an async dashboard opened with use_iterator_for_get_pages
+        hands back as an async iterator, the SDK follows meraki's Link headers from page to page. a token is taken
+        for each page, counted by perPage, the SDK asks for the next page as soon as one arrives so the limiter
+        runs a page behind. a 429 is only retried before any item has been handed on, after that it's raised"""
+        perPage = kwargs.get("perPage")
+        started = time.perf_counter()
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            wait = self.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            count = 0
+            try:
+                async for item in func(*args, **kwargs):
+                    count += 1
+                    if perPage and count % perPage == 0:
+                        # the last item of a full page, account for it and take a token for the next page
+                        self.onSuccess()
+                        callMetrics.record(func, started, attempt, limiter=self)
+                        started, attempt = time.perf_counter(), 0
+                        wait = self.reserve()
+                        if wait > 0:
+                            await asyncio.sleep(wait)
+                    yield item
+            except Exception as e:
+                if count or getattr(e, "status", None) != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+                    callMetrics.record(func, started, attempt, e, limiter=self)
+                    raise
+                self.onRateLimited(getRetryAfter(e))
+                continue
+            self.onSuccess()
+            callMetrics.record(func, started, attempt, limiter=self)
+            return
+
+def getRetryAfter(error):
+    """read the Retry-After header from a 429 error, defaulting to one second"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After", 1))
+    except (TypeError, ValueError):
+        return 1
+
+class ThrottledDashboard:
+    """Wraps a meraki.DashboardAPI (or AsyncDashboardAPI with asyncMode) so every call made through any of its
+    sections (switch, devices...) goes through the shared rate limiter, callers use it exactly like the dashboard it wraps"""
+    def __init__(self, api, limiter, asyncMode = False):
+        self.api = api
+        self.limiter = limiter
+        self.asyncMode = asyncMode
+
+    def __getattr__(self, sectionName):
+        return ThrottledSection(getattr(self.api, sectionName), self.limiter, self.asyncMode)
+
+class ThrottledSection:
+    def __init__(self, section, limiter, asyncMode = False):
+        self.section = section
+        self.limiter = limiter
+        self.asyncMode = asyncMode
+
+    def __getattr__(self, name):
+        func = getattr(self.section, name)
+        if not callable(func):
+            return func
+        if self.asyncMode:
+            def throttledAsync(*args, **kwargs):
+                return ThrottledCall(self.limiter, func, args, kwargs)
+            return throttledAsync
+        def throttled(*args, **kwargs):
+            return self.limiter.call(func, *args, **kwargs)
+        return throttled
+
+class ThrottledCall:
+    """A call on an async dashboard that hasn't been made yet. await it for the response like the SDK's own
+    calls, or for a paginated call on a dashboard opened with use_iterator_for_get_pages go through its items
+    with async for, either way it goes through the rate limiter"""
+    def __init__(self, limiter, func, args, kwargs):
+        self.limiter = limiter
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __await__(self):
+        return self.limiter.callAsync(self.func, *self.args, **self.kwargs).__await__()
+
+    def __aiter__(self):
+        return self.limiter.iterateAsync(self.func, *self.args, **self.kwargs)
+
+#-------------------------------------------------------------------------------------
+# INSTRUMENTATION
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)    # histogram buckets in seconds for the prometheus export
+
+class CallMetrics:
+    """Counts, latencies, retries and 429s of every dashboard call by endpoint, recorded by the rate limiter,
+    plus spans timing each bulk operation. saved as prometheus text or a JSON summary at the end of a run"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}     # endpoint -> {"calls", "errors", "retries", "rateLimited", "seconds", "buckets"}
+        self.spans = []
+        self.totals = {None: [0, 0]}   # rate limiter -> [calls, 429s], None for every org together
+
+    def record(self, func, started, retries, error = None, limiter = None):
+        """record one call, retries is how many 429s it was retried after. limiter is the rate limiter of the org
+        the call was made for, spans count calls by it so orgs running in parallel don't count each other's calls"""
+        seconds = time.perf_counter() - started
+        endpoint = getattr(func, "__name__", "unknown")
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {"calls": 0, "errors": 0, "retries": 0, "rateLimited": 0, "seconds": 0.0,
+                                                         "buckets": [0] * len(LATENCY_BUCKETS)})
+            stats["calls"] += 1
+            stats["retries"] += retries
+            rateLimited = retries + (1 if getattr(error, "status", None) == 429 else 0)
+            stats["rateLimited"] += rateLimited
+            stats["errors"] += 1 if error is not None else 0
+            stats["seconds"] += seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][index] += 1
+            for key in {None, limiter}:
+                totals = self.totals.setdefault(key, [0, 0])
+                totals[0] += 1
+                totals[1] += rateLimited
+
+    def totalsFor(self, limiter):
+        """the calls and 429s recorded so far for an org's rate limiter, or for every org when it's None"""
+        with self.lock:
+            return tuple(self.totals.get(limiter, (0, 0)))
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """time a bulk operation along with how many calls and 429s it made. inside an org's client context only that
+        org's calls are counted, outside of one the calls of every org are"""
+        limiter = getattr(activeClient.get(None), "rateLimiter", None)
+        startNs, (calls, rateLimited) = time.time_ns(), self.totalsFor(limiter)
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            endCalls, endRateLimited = self.totalsFor(limiter)
+            attributes.update({"calls": endCalls - calls, "rateLimited": endRateLimited - rateLimited})
+            with self.lock:
+                self.spans.append({"name": name, "spanId": os.urandom(8).hex(), "startTimeUnixNano": startNs,
+                                   "endTimeUnixNano": time.time_ns(), "status": "ERROR" if error else "OK", "attributes": attributes})
+
+    def summary(self):
+        with self.lock:
+            return {"endpoints": {endpoint: {"calls": stats["calls"], "errors": stats["errors"], "retries": stats["retries"],
+                                             "rateLimited": stats["rateLimited"], "totalSeconds": round(stats["seconds"], 3),
+                                             "averageSeconds": round(stats["seconds"] / stats["calls"], 4)}
+                                  for endpoint, stats in sorted(self.endpoints.items())},
+                    "spans": list(self.spans)}
+
+    def prometheus(self):
+        """the metrics in prometheus' text exposition format"""
+        lines = []
+        counters = (("meraki_api_calls_total", "calls", "Dashboard API calls"),
+                    ("meraki_api_errors_total", "errors", "Dashboard API calls that failed"),
+                    ("meraki_api_retries_total", "retries", "Dashboard API calls retried after a 429"),
+                    ("meraki_api_rate_limited_total", "rateLimited", "429 responses from the Dashboard API"))
+        with self.lock:
+            for metric, key, description in counters:
+                lines += [f"# HELP {metric} {description}", f"# TYPE {metric} counter"]
+                lines += [f'{metric}{{endpoint="{endpoint}"}} {stats[key]}' for endpoint, stats in sorted(self.endpoints.items())]
+            metric = "meraki_api_call_duration_seconds"
+            lines += [f"# HELP {metric} Time a Dashboard API call took including rate limit waits", f"# TYPE {metric} histogram"]
+            for endpoint, stats in sorted(self.endpoints.items()):
+                lines += [f'{metric}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}' for bound, count in zip(LATENCY_BUCKETS, stats["buckets"])]
+                lines += [f'{metric}_bucket{{endpoint="{endpoint}",le="+Inf"}} {stats["calls"]}',
+                          f'{metric}_sum{{endpoint="{endpoint}"}} {stats["seconds"]:.6f}',
+                          f'{metric}_count{{endpoint="{endpoint}"}} {stats["calls"]}']
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename):
+        """write prometheus text for a .prom file, otherwise the JSON summary"""
+        with open(filename, "w") as file:
+            if filename.endswith(".prom"):
+                file.write(self.prometheus())
+            else:
+                json.dump(self.summary(), file, indent=2)
+
+# one set of metrics for the whole process, every dashboard call is recorded by the rate limiter
+callMetrics = CallMetrics()
+
+def traced(func):
+    """record a span each time a bulk operation runs"""
+    @functools.wraps(func)
+    def tracedFunc(*args, **kwargs):
+        with callMetrics.span(func.__name__):
+            return func(*args, **kwargs)
+    return tracedFunc
+#-------------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------------
+# ASYNC ENGINE
+MAX_CONCURRENT_REQUESTS = 50    # requests allowed in flight at once on the event loop
+JOB_RETRIES = 2                 # times a failed job is put back on the queue before it's recorded as failed
+JOB_RETRY_DELAY = 1             # seconds a worker waits before requeueing a failed job, multiplied by the attempt
+
+def runAsync(operation):
+    """opens an async dashboard for the current client, runs operation(aioDashboard) on one event loop then closes
+    the dashboard. returns whatever the operation returns"""
+    client = currentClient()
+    async def main():
+        async with client.openAsyncDashboard() as aioDashboard:
+            return await operation(ThrottledDashboard(aioDashboard, client.rateLimiter, asyncMode = True))
+    return asyncio.run(main())
+
+class JobResult:
+    """outcome of one job run through the job queue"""
+    def __init__(self, item, value = None, error = None, attempts = 0):
+        self.item = item
+        self.value = value
+        self.error = error
+        self.attempts = attempts
+
+    @property
+    def ok(self):
+        return self.error is None
+
+async def runJobQueue(items, coroutineFunc, workers = MAX_CONCURRENT_REQUESTS, retries = JOB_RETRIES):
+    """awaits coroutineFunc(item) for every item using a pool of workers that all pull from one shared queue,
+    so a slow or retried job only holds up the worker running it. a job that raises is put back on the end of
+    the queue until it has been retried retries times, then its error is recorded
+    returns a JobResult for every item in the same order as items"""
+    jobQueue = asyncio.Queue()
+    for index, item in enumerate(items):
+        jobQueue.put_nowait((index, item, 1))
+    results = [None] * len(items)
+
+    async def worker():
+        while True:
+            try:
+                index, item, attempt = jobQueue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                results[index] = JobResult(item, await coroutineFunc(item), None, attempt)
+            except Exception as e:
+                if attempt <= retries:
+                    await asyncio.sleep(JOB_RETRY_DELAY * attempt)
+                    jobQueue.put_nowait((index, item, attempt + 1))
+                else:
+                    results[index] = JobResult(item, None, e, attempt)
+
+    await asyncio.gather(*(worker() for _ in range(min(workers, len(items)))))
+    return results
+
+def reportJobs(results, label, describe = str):
+    """prints how many jobs succeeded, how many needed retries and the error for each one that failed,
+    describe turns a job's item into the text printed for it. returns the failed results"""
+    failed = [result for result in results if not result.ok]
+    retried = sum(1 for result in results if result.attempts > 1)
+    print(f"\n{label}: {len(results) - len(failed)} succeeded, {len(failed)} failed, {retried} needed a retry")
+    for result in failed:
+        print(f"Failed {describe(result.item)} after {result.attempts} attempts: {result.error}")
+    return failed
+
+#-------------------------------------------------------------------------------------
+# CLIENT CONTEXT
+activeClient = contextvars.ContextVar("activeClient")   # the MerakiClient for the org being worked on
+
+class MerakiClient:
+    """Everything needed to work on one organization: its dashboard, its own rate limiter and its org ID.
+    the async dashboard's connection pool is sized to MAX_CONCURRENT_REQUESTS, the requests runJobQueue keeps in
+    flight, the sync dashboard is only used by one thread per org so the SDK's default pool is plenty.
+    api and asyncApi replace the real dashboards, asyncApi being a callable that opens an async dashboard"""
+    def __init__(self, apiKey, orgID = None, orgName = None, api = None, asyncApi = None, ratePerSecond = ORG_REQUESTS_PER_SECOND):
+        self.apiKey = apiKey
+        self.orgName = orgName or orgID
+        self.rateLimiter = RateLimiter(ratePerSecond)
+        if api is None:
+            # 429s are handed back to the client's rate limiter instead of being retried inside the SDK
+            api = loadMeraki().DashboardAPI(apiKey, output_log=False, print_console=False, suppress_logging=True, wait_on_rate_limit=False)
+        self.dashboard = ThrottledDashboard(api, self.rateLimiter)
+        self.asyncApi = asyncApi
+        self.switches = None    # the org's switches once they've been read
+        self.orgID = orgID
+
+    def getOrganizations(self):
+        """every organization the API key can see"""
+        return self.dashboard.organizations.getOrganizations()
+
+    def forOrganization(self, org):
+        """a client of the same kind for another organization with the same key, it gets its own rate limiter and caches"""
+        return type(self)(self.apiKey, org['id'], org.get('name'), ratePerSecond=self.rateLimiter.maxRate)
+
+    def openAsyncDashboard(self):
+        """opens an async dashboard for this client's key, its session keeps up to MAX_CONCURRENT_REQUESTS
+        connections alive and paginated calls come back as iterators to go through with async for, use it with async with"""
+        if self.asyncApi:
+            return self.asyncApi()
+        return loadMeraki().aio.AsyncDashboardAPI(self.apiKey, output_log=False, print_console=False, suppress_logging=True,
+                                            wait_on_rate_limit=False, maximum_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+                                            use_iterator_for_get_pages=True)
+
+def selectOrganizations(orgs, selection = None):
+    """picks organizations by a comma separated list of names and IDs or all, names ignore case.
+    with no selection the first organization is used. raises ValueError naming any that weren't found"""
+    if not selection:
+        return orgs[:1]
+    if selection.strip().lower() == "all":
+        return list(orgs)
+    byKey = {}
+    for org in orgs:
+        byKey[str(org['id'])] = org
+        byKey.setdefault(str(org.get('name', '')).lower(), org)
+    chosen = []
+    unknown = []
+    for entry in selection.split(","):
+        entry = entry.strip()
+        org = byKey.get(entry) or byKey.get(entry.lower())
+        if org is None:
+            unknown.append(entry)
+        elif org not in chosen:
+            chosen.append(org)
+    if unknown:
+        raise ValueError(f"No organization {', '.join(unknown)} found, the key can see {', '.join(str(org.get('name')) for org in orgs)}")
+    return chosen
+
+def currentClient():
+    """the client the current thread or task is working with, set with useClient"""
+    return activeClient.get()
+
+@contextlib.contextmanager
+def useClient(client):
+    """makes client the current one for the code inside the with block, tasks started inside it inherit it"""
+    token = activeClient.set(client)
+    try:
+        yield client
+    finally:
+        activeClient.reset(token)
+#-------------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------------
+# SWITCH INVENTORY
+SWITCH_CACHE_FILE = "switch_inventory_{}.json"    # one per organization, filled in with the org ID
+SWITCH_CACHE_TTL = 3600         # seconds the cached switch list is trusted before asking meraki if anything changed
+SWITCH_CACHE_MAX_AGE = 86400    # seconds after which the switch list is always downloaded again
+
+def fetchSwitches(client):
+    """Download every switch in the client's organization, meraki filters out the other device types"""
+    return client.dashboard.organizations.getOrganizationDevices(client.orgID, total_pages='all', productTypes=['switch'])
+
+def switchesChangedSince(client, timestamp):
+    """ask the org's configuration change log whether anything has changed since timestamp,
+    one small request that saves downloading the whole device list when nothing has"""
+    since = datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return bool(client.dashboard.organizations.getOrganizationConfigurationChanges(client.orgID, t0=since, perPage=1, total_pages=1))
+
+def getSwitches(client, cacheFile = None, refresh = False):
+    """Retrieve all switches in the client's organization, kept between runs in cacheFile which defaults to
+    SWITCH_CACHE_FILE in the working directory. the cache is used as is for SWITCH_CACHE_TTL, after that it's only
+    downloaded again if the org's change log shows something changed or it's older than SWITCH_CACHE_MAX_AGE.
+    refresh always downloads"""
+    cacheFile = cacheFile or SWITCH_CACHE_FILE.format(client.orgID)
+    now = time.time()
+    cache = {}
+    if not refresh and os.path.exists(cacheFile):
+        try:
+            with open(cacheFile, "r") as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            cache = {}  # a damaged cache is just downloaded again
+    if cache.get("orgId") == client.orgID and now - cache.get("fetchedAt", 0) < SWITCH_CACHE_MAX_AGE:
+        if now - cache["checkedAt"] < SWITCH_CACHE_TTL:
+            return cache["switches"]
+        try:
+            if not switchesChangedSince(client, cache["checkedAt"]):
+                cache["checkedAt"] = now
+                saveSwitchCache(cacheFile, cache)
+                return cache["switches"]
+        except Exception:
+            # if the change log can't be read fall back to downloading the switches. not meraki.APIError,
+            # the SDK may not have been imported when the dashboard was passed in
+            pass
+    switches = fetchSwitches(client)
+    saveSwitchCache(cacheFile, {"orgId": client.orgID, "fetchedAt": now, "checkedAt": now, "switches": switches})
+    return switches
+
+def saveSwitchCache(cacheFile, cache):
+    """write the switch cache to a temporary file first so a crash never leaves half a cache behind"""
+    with open(cacheFile + ".tmp", "w") as file:
+        json.dump(cache, file)
+    os.replace(cacheFile + ".tmp", cacheFile)
+#-------------------------------------------------------------------------------------